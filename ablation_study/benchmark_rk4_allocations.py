@@ -0,0 +1,44 @@
+# compare the RK4 integrator that allocates its stages with the one that writes them into preallocated buffers:
+# time per solve, and the peak of the temporary memory allocated on top of the output trajectories.
+# the candidate ODE is lambdified and wrapped the same way as in `compile_simulator`.
+import timeit
+import tracemalloc
+
+import click
+import numpy as np
+from sympy import symbols, lambdify
+
+from grammar.odeint.numpy_odeint import batched_rhs, batch_runge_kutta4, runge_kutta4_inplace, rk4_workspace
+
+
+@click.command()
+@click.option('--time_steps', default=1000, type=int, help="number of time steps of the solve.")
+@click.option('--repeat', default=7, type=int, help="the best of this many timings is reported.")
+def main(time_steps, repeat):
+    X = symbols('X0:3')
+    t = symbols('t')  # not used in this case
+    num_function = lambdify((t, *X), [X[0] * X[1] - 0.5 * X[2], X[0] - X[1], 0.5 * X[0] * X[2]], cse=True)
+    derivative = batched_rhs(lambda t, state: num_function(t, *state))
+    t_eval = np.linspace(0, 10, time_steps)
+    for batch_size in [1, 10, 100, 1000, 10000]:
+        x_inits = np.random.rand(batch_size, 3)
+        workspace = rk4_workspace(x_inits.shape)
+        output_size = t_eval.nbytes * x_inits.size
+        results = []
+        for name, integrator in [('batch_runge_kutta4',
+                                  lambda: batch_runge_kutta4(derivative, t_eval, x_inits)),
+                                 ('runge_kutta4_inplace',
+                                  lambda: np.moveaxis(runge_kutta4_inplace(derivative, t_eval, x_inits, workspace),
+                                                      0, -2))]:
+            used_time = min(timeit.repeat(integrator, number=3, repeat=repeat)) / 3
+            tracemalloc.start()
+            results.append(integrator())
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print("batch_size={} {}: used time {:.2f}ms, temporary memory {:.1f}KB".format(
+                batch_size, name, used_time * 1e3, (peak - output_size) / 1024))
+        print("same output:", np.array_equal(results[0], results[1], equal_nan=True))
+
+
+if __name__ == '__main__':
+    main()
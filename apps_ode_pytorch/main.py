@@ -1,3 +1,4 @@
+import atexit
 import torch
 import time
 import click
@@ -9,6 +10,7 @@ from grammar.grammar import ContextFreeGrammar
 from grammar.grammar_regress_task import RegressTask
 from grammar.production_rules import get_production_rules, construct_non_terminal_nodes_and_start_symbols
 from grammar.grammar_program import grammarProgram
+from grammar.expression_cache import compiled_expressions
 from active_deep_symbolic_regression import ActDeepSymbolicRegression
 
 threshold_values = {
@@ -37,8 +39,45 @@ threshold_values = {
 @click.option('--use_gpu', default=-1, help="use GPU or cpu for training")
 @click.option('--active_mode', default='default', help="use which active learning algorithm")
 @click.option('--time_sequence_drop_rate', default=0, type=float, help="simulate irregular time sequence")
+@click.option('--integrator_backend', default='numpy', type=click.Choice(['numpy', 'numba', 'torch']),
+              help="integrator for simulating the candidate ODEs. torch fits all the candidates together (Adam, LBFGS)")
+@click.option('--integrator_method', default='rk4', type=click.Choice(['rk4', 'rk45', 'euler']),
+              help="rk4, rk45 (adaptive, numpy backend only) or euler (numba backend only)")
+@click.option('--divergence_threshold', default=None, type=float,
+              help="stop simulating a candidate once its state exceeds this magnitude")
+@click.option('--use_sensitivity', is_flag=True, default=False,
+              help="exact loss gradients from the forward sensitivity equations (BFGS, CG, L-BFGS-B)")
+@click.option('--screening_precision', default=None, type=click.Choice(['float32']),
+              help="fit and score the candidates in this precision first, then re-fit the best ones in float64")
+@click.option('--refit_fraction', default=0.2, type=float, help="fraction of the screened candidates re-fitted")
+@click.option('--compile_cache_path', default=None, type=str,
+              help="load the compiled candidate ODEs from this file and save them back at exit")
+@click.option('--memo_capacity', default=0, type=int,
+              help="number of fitted templates remembered across epochs, to skip or warm-start their re-fitting")
+@click.option('--memo_eviction', default='lru', type=click.Choice(['lru', 'fifo', 'worst']))
+@click.option('--memo_refine_iters', default=10, type=int, help="iterations of a warm-started re-fitting")
+@click.option('--linear_fit_iters', default=None, type=int,
+              help="fit the candidates linear in their constants by least squares, then refine with these iterations")
+@click.option('--derivative_prefit', is_flag=True, default=False,
+              help="start fitting from the constants that match the smoothed time derivatives of the trajectories")
+@click.option('--n_starts', default=1, type=int, help="number of random starts of the optimizer, evaluated together")
+@click.option('--schedule', default='dynamic', type=click.Choice(['dynamic', 'static']),
+              help="share the candidates among the cores on demand (most expensive first), or in fixed slices")
+@click.option('--schedule_chunk_size', default=1, type=int, help="candidates handed out at a time by the dynamic schedule")
+@click.option('--time_budget', default=None, type=float, help="seconds the fit of one candidate may take")
+@click.option('--eval_budget', default=None, type=int, help="objective evaluations the fit of one candidate may take")
+@click.option('--halving_rounds', default=0, type=int, help="rounds of successive halving, 0 to disable")
+@click.option('--halving_eta', default=3, type=int, help="promote the best 1/halving_eta every round")
 def main(config_template, optimizer, equation_name, metric_name, num_init_conds, num_regions, noise_type, noise_scale,
-         max_len, total_iterations, n_cores, use_gpu, active_mode, time_sequence_drop_rate):
+         max_len, total_iterations, n_cores, use_gpu, active_mode, time_sequence_drop_rate, integrator_backend,
+         integrator_method, divergence_threshold, use_sensitivity, screening_precision, refit_fraction,
+         compile_cache_path, memo_capacity, memo_eviction, memo_refine_iters,
+         linear_fit_iters, derivative_prefit, n_starts, schedule, schedule_chunk_size,
+         time_budget, eval_budget, halving_rounds, halving_eta):
+    if compile_cache_path is not None:
+        # loaded before the worker processes are forked, so they share the persisted entries.
+        compiled_expressions.load(compile_cache_path)
+        atexit.register(compiled_expressions.save, compile_cache_path)
     data_query_oracle = Equation_evaluator(equation_name,
                                            noise_type, noise_scale,
                                            metric_name=metric_name,
@@ -75,7 +114,25 @@ def main(config_template, optimizer, equation_name, metric_name, num_init_conds,
         optimizer=optimizer,
         metric_name=metric_name,
         n_cores=n_cores,
-        max_opt_iter=max_opt_iter
+        max_opt_iter=max_opt_iter,
+        integrator_backend=integrator_backend,
+        integrator_method=integrator_method,
+        divergence_threshold=divergence_threshold,
+        use_sensitivity=use_sensitivity,
+        screening_precision=screening_precision,
+        refit_fraction=refit_fraction,
+        memo_capacity=memo_capacity,
+        memo_eviction=memo_eviction,
+        memo_refine_iters=memo_refine_iters,
+        linear_fit_iters=linear_fit_iters,
+        derivative_prefit=derivative_prefit,
+        n_starts=n_starts,
+        schedule=schedule,
+        schedule_chunk_size=schedule_chunk_size,
+        time_budget=time_budget,
+        eval_budget=eval_budget,
+        halving_rounds=halving_rounds,
+        halving_eta=halving_eta
     )
     grammar_model = ContextFreeGrammar(
         nvars=nvars,
@@ -119,6 +176,7 @@ def main(config_template, optimizer, equation_name, metric_name, num_init_conds,
     used = time.time() - start
 
     grammar_model.print_topk_expressions(verbose=True)
+    print("compiled expressions cache:", compiled_expressions.cache_info())
     print("APPS time {} mins".format(np.round(used / 60, 3)))
 
 
@@ -27,6 +27,16 @@ class KnownEquation(object):
         self.vars_range_and_types = vars_range_and_types
         self.x = [Symbol(f'X{i}', real=True) for i in range(num_vars)]
 
+    def np_eq_batch(self, t, x):
+        """
+        the time derivative of a batch of states, with the `np_eq(t, x)` of the subclass. np_eq takes [nvars] for
+        one state, or [nvars, batch_size] for a batch of states (one row per variable), and evaluates every component
+        element-wise, so its return has the same shape as x.
+        x: [batch_size, nvars]
+        return: [batch_size, nvars]
+        """
+        return self.np_eq(t, x.T).T
+
     def vars_range_and_types_to_json_str(self):
         if self.vars_range_and_types:
             return json.dumps([one.to_dict() for one in self.vars_range_and_types])
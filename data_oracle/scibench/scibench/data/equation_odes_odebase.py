@@ -1024,7 +1024,7 @@ class BIOMD0000000520(KnownEquation):
                          '1.0*x[1]**2/(x[1] + 29.24) + 0.547*x[1] - 1.83*x[2]']
 
     def np_eq(self, t, x):
-        return np.array([0,
+        return np.array([np.full_like(x[0], 0),
                          1.0 * x[0] ** 2 / (x[0] + 2.924) + 0.218 * x[0] - 0.024 * x[1],
                          1.0 * x[1] ** 2 / (x[1] + 29.24) + 0.547 * x[1] - 1.83 * x[2]])
 
@@ -1329,7 +1329,7 @@ class BIOMD0000000957(KnownEquation):
         self.sympy_eq = ['0', '-1.009*x[1]', '0.1*x[1]', '0.909*x[1]']
 
     def np_eq(self, t, x):
-        return np.array([0,
+        return np.array([np.full_like(x[0], 0),
                          -1.009 * x[1],
                          0.1 * x[1],
                          0.909 * x[1]])
@@ -1398,7 +1398,7 @@ class BIOMD0000000765(KnownEquation):
 
     def np_eq(self, t, x):
         return np.array([-0.1 * x[0] * x[2] - 1.0 * x[0] + 0.1 * x[3],
-                         0,
+                         np.full_like(x[0], 0),
                          -0.1 * x[0] * x[2] - 0.566 * x[2] + 0.1 * x[3],
                          0.1 * x[0] * x[2] - 0.1 * x[3]])
 
@@ -1441,10 +1441,10 @@ class BIOMD0000000460(KnownEquation):
         self.sympy_eq = ['0', '0.052*x[2] + 1.0e+4', '-0.052*x[2]', '0']
 
     def np_eq(self, t, x):
-        return np.array([0,
+        return np.array([np.full_like(x[0], 0),
                          0.052 * x[2] + 1.0e+4,
                          -0.052 * x[2],
-                         0])
+                         np.full_like(x[0], 0)])
 
 
 @register_eq_class
@@ -1464,7 +1464,7 @@ class BIOMD0000000880(KnownEquation):
 
     def np_eq(self, t, x):
         return np.array([0.431 * x[0],
-                         0,
+                         np.full_like(x[0], 0),
                          0.234 * x[2],
                          -1.7e-5 * x[3] ** 2 + 0.017 * x[3]])
 
@@ -1561,7 +1561,7 @@ class BIOMD0000000904(KnownEquation):
                          1.0 * x[0] - 0.9 * x[1] * x[2] - 1.2 * x[1],
                          -0.085 * x[0] * x[2] - 0.085 * x[1] * x[2] + 0.1 * x[2] * (x[0] + x[1]) ** 3.0 / (
                                      (x[0] + x[1]) ** 3.0 + 0.2) - 0.29 * x[2] + 0.029,
-                         0])
+                         np.full_like(x[0], 0)])
 
 
 @register_eq_class
@@ -1641,10 +1641,10 @@ class BIOMD0000000866(KnownEquation):
         self.sympy_eq = ['0', '-0.05*x[1]*x[3]/(x[1] + 10.0) + 0.5', '0.05*x[1]*x[3]/(x[1] + 10.0)', '0']
 
     def np_eq(self, t, x):
-        return np.array([0,
+        return np.array([np.full_like(x[0], 0),
                          -0.05 * x[1] * x[3] / (x[1] + 10.0) + 0.5,
                          0.05 * x[1] * x[3] / (x[1] + 10.0),
-                         0])
+                         np.full_like(x[0], 0)])
 
 
 @register_eq_class
@@ -1686,8 +1686,8 @@ class BIOMD0000000233(KnownEquation):
         self.sympy_eq = ['0', '0', '-1.0*x[2]**2 - 1.0*x[2]*x[3] - 1.5*x[2] + 16.0*x[3]', '1.0*x[2]**2 - 8.0*x[3]']
 
     def np_eq(self, t, x):
-        return np.array([0,
-                         0,
+        return np.array([np.full_like(x[0], 0),
+                         np.full_like(x[0], 0),
                          -1.0 * x[2] ** 2 - 1.0 * x[2] * x[3] - 1.5 * x[2] + 16.0 * x[3],
                          1.0 * x[2] ** 2 - 8.0 * x[3]])
 
@@ -1713,7 +1713,7 @@ class BIOMD0000000642(KnownEquation):
         return np.array([-0.3 * x[0] ** 2 - 1.0 * x[0] * x[1] + 0.1 * x[0],
                          0.47 * x[0] - 0.4 * x[1] ** 2 - 0.9 * x[1] * x[2] + 1.0 * x[1],
                          -0.085 * x[1] * x[2] + 0.2 * x[1] * x[2] / (x[1] + 0.3) - 0.4567 * x[2] + 0.4,
-                         0])
+                         np.full_like(x[0], 0)])
 
 
 @register_eq_class
@@ -1872,7 +1872,7 @@ class BIOMD0000000363(KnownEquation):
         return np.array([-0.005 * x[0],
                          0.005 * x[0] - 0.01 * x[1],
                          0.01 * x[1],
-                         0])
+                         np.full_like(x[0], 0)])
 
 
 @register_eq_class
@@ -1922,7 +1922,7 @@ class BIOMD0000000289(KnownEquation):
                          0.016 * x[0] * x[2] + 200.0 * x[0] - 0.25 * x[1],
                          1000.0 * x[0] - 0.25 * x[2],
                          2000.0 * x[2] - 5.003 * x[3],
-                         0])
+                         np.full_like(x[0], 0)])
 
 
 @register_eq_class
@@ -1947,7 +1947,7 @@ class BIOMD0000000980(KnownEquation):
                          0.168 * x[0] * x[2] / x[4] - 0.192 * x[1],
                          0.192 * x[1] - 0.056 * x[2],
                          0.056 * x[2] - 0.017 * x[3],
-                         0])
+                         np.full_like(x[0], 0)])
 
 
 @register_eq_class
@@ -1968,10 +1968,10 @@ class BIOMD0000000869(KnownEquation):
                          '-0.05*x[3]*x[4]/(x[4] + 10.0)']
 
     def np_eq(self, t, x):
-        return np.array([0,
+        return np.array([np.full_like(x[0], 0),
                          -0.05 * x[1] * x[3] / (x[1] + 10.0) + 0.5,
                          0.05 * x[1] * x[3] / (x[1] + 10.0),
-                         0,
+                         np.full_like(x[0], 0),
                          -0.05 * x[3] * x[4] / (x[4] + 10.0)])
 
 
@@ -1993,7 +1993,7 @@ class BIOMD0000000868(KnownEquation):
                          '0.005*x[1]*x[3] - 0.05*x[4]']
 
     def np_eq(self, t, x):
-        return np.array([0,
+        return np.array([np.full_like(x[0], 0),
                          -0.005 * x[1] * x[3] + 0.5,
                          0.05 * x[4],
                          -0.005 * x[1] * x[3] + 0.05 * x[4],
@@ -2152,7 +2152,7 @@ class BIOMD0000000979(KnownEquation):
                          0.168 * x[0] * x[2] / x[4] - 0.192 * x[1],
                          0.192 * x[1] - 0.056 * x[2],
                          0.056 * x[2] - 0.017 * x[3],
-                         0])
+                         np.full_like(x[0], 0)])
 
 
 @register_eq_class
@@ -2334,7 +2334,7 @@ class BIOMD0000000984(KnownEquation):
                          1.0 * x[0] * x[2] / x[4] - 0.143 * x[1],
                          0.143 * x[1] - 0.098 * x[2],
                          0.098 * x[2],
-                         0])
+                         np.full_like(x[0], 0)])
 
 
 @register_eq_class
@@ -2356,10 +2356,10 @@ class BIOMD0000000040(KnownEquation):
 
     def np_eq(self, t, x):
         return np.array([-1.6e+9 * x[0] * x[3] - 0.0804 * x[0] + 1.0 * x[2],
-                         0,
+                         np.full_like(x[0], 0),
                          -1.0 * x[2] + 480.0 * x[3],
                          -1.6e+9 * x[0] * x[3] + 0.0804 * x[0] - 8.0e+7 * x[3] ** 2 + 480.0 * x[3],
-                         0])
+                         np.full_like(x[0], 0)])
 
 
 @register_eq_class
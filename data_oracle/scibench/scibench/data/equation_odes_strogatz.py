@@ -1242,7 +1242,7 @@ class FourWingChaoticAttractor(KnownEquation):
 
     def np_eq(self, t, x):
         return np.array([
-            1,
+            np.full_like(x[0], 1),
             x[2],
             -self.delta * x[2] - self.alpha * x[1] - self.beta * x[1] ** 3 + self.gamma * np.cos(self.omega * x[0]),
         ])
@@ -24,12 +24,17 @@ class {}(KnownEquation):
 """
 
 
+def np_component(one_expr):
+    # a constant component is broadcast to the shape of x[0], so np_eq also evaluates a batch of states.
+    return one_expr if 'x[' in one_expr else 'np.full_like(x[0], {})'.format(one_expr)
+
+
 def fill_template(expressions, class_name, name, nvars, description, function_set):
     element = 'LogUniformSampling((1e-2, 10.0), only_positive=True)'
     elements = ", ".join([element for _ in range(int(nvars))])
     return template.format(class_name, name, function_set, description, elements, nvars,
                            expressions,
-                           ", ".join(expressions))
+                           ", ".join([np_component(ei) for ei in expressions]))
 
 
 def detect_function_set(one_ode):
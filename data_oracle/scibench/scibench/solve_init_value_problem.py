@@ -39,6 +39,27 @@ def runge_kutta4(func, times, x_init):
     return y
 
 
+def batch_runge_kutta4(func, times, x_inits):
+    """
+    solve a batch of initial conditions at once.
+    func: maps (t, x) to the derivative, where x has the shape [batch_size, nvars]. See `KnownEquation.np_eq_batch`.
+    x_inits: [batch_size, nvars]
+    return: [batch_size, time_steps, nvars]
+    """
+    x_inits = np.asarray(x_inits, dtype=float)
+    n = len(times)
+    y = np.zeros((n,) + x_inits.shape)
+    y[0] = x_inits
+    for i in range(len(times) - 1):
+        h = times[i + 1] - times[i]
+        k1 = func(times[i], y[i])
+        k2 = func(times[i] + h / 2., y[i] + k1 * h / 2)
+        k3 = func(times[i] + h / 2, y[i] + k2 * h / 2)
+        k4 = func(times[i] + h, y[i] + k3 * h)
+        y[i + 1] = y[i] + h / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+    return np.moveaxis(y, 0, 1)
+
+
 def compare_with_scipy_solve_ivp():
     """
     the following testing case show the inplemented version is highly accurate.
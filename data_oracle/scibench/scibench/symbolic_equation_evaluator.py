@@ -1,7 +1,7 @@
 import numpy as np
 
 from scipy.integrate import solve_ivp
-from scibench.solve_init_value_problem import runge_kutta4, runge_kutta2, euler_method
+from scibench.solve_init_value_problem import runge_kutta2, euler_method, batch_runge_kutta4
 from sympy import lambdify, symbols
 from scibench.metrics import all_metrics, construct_noise
 from scibench.data import equation_object_loader
@@ -30,8 +30,6 @@ class Equation_evaluator(object):
         self.vars_range_and_types = self.true_equation.vars_range_and_types
         self.vars_range_and_types_to_json = self.true_equation.vars_range_and_types_to_json_str()
         self.input_var_Xs = self.true_equation.x
-        #
-        self.true_ode_equation = self.true_equation.np_eq
         # metric
         self.metric_name = metric_name
         self.metric = all_metrics[metric_name]
@@ -41,22 +39,39 @@ class Equation_evaluator(object):
         self.noise_scale = noise_scale
         self.noises = construct_noise(self.noise_type)
         self.time_sequence_drop_rate = time_sequence_drop_rate
+        # noiseless true trajectories of the current epoch, keyed by the initial conditions and the time grid.
+        self.trajectory_cache = {}
 
-    def evaluate(self, x_init_conds: list, time_span: tuple, t_evals: np.ndarray) -> np.ndarray:
+    def reset_trajectory_cache(self):
         """
-        compute the true trajectory for each x_init_cond
+        forget the cached true trajectories. called at the start of every epoch.
         """
-        true_trajectories = []
-        for one_x_init in x_init_conds:
-            # one_solution = solve_ivp(self.true_ode_equation, t_span=time_span, t_evals=t_evals, y0=one_x_init,
-            #                          method='RK45')
-            # true_trajectories.append(one_solution.y)
-            one_solution = runge_kutta4(self.true_ode_equation, t_evals, one_x_init)
-            true_trajectories.append(one_solution)
-        true_trajectories = np.asarray(true_trajectories)
+        self.trajectory_cache = {}
 
+    def evaluate(self, x_init_conds: list, time_span: tuple, t_evals: np.ndarray) -> np.ndarray:
+        """
+        compute the true trajectory for each x_init_cond, with a fresh draw of the noise.
+        """
+        true_trajectories = self.simulate(x_init_conds, time_span, t_evals)
         return true_trajectories + self.noises(self.noise_scale, true_trajectories.shape)
 
+    def simulate(self, x_init_conds: list, time_span: tuple, t_evals: np.ndarray) -> np.ndarray:
+        """
+        compute the noiseless true trajectory for each x_init_cond.
+        the same query is answered from the cache, so the true system is integrated once per distinct query.
+        """
+        x_init_conds = np.asarray(x_init_conds, dtype=float)
+        t_evals = np.asarray(t_evals, dtype=float)
+        key = (x_init_conds.shape, x_init_conds.tobytes(), t_evals.tobytes())
+        if key in self.trajectory_cache:
+            return self.trajectory_cache[key]
+        # all the initial conditions are integrated together.
+        true_trajectories = batch_runge_kutta4(self.true_equation.np_eq_batch, t_evals, x_init_conds)
+        # the cached array is shared by the later queries, so it must not be modified in place.
+        true_trajectories.flags.writeable = False
+        self.trajectory_cache[key] = true_trajectories
+        return true_trajectories
+
     def _evaluate_loss(self, X_init_cond, time_span: tuple, t_evals: np.ndarray,
                        pred_trajectories: np.ndarray) -> float:
         """
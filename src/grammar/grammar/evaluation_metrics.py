@@ -28,3 +28,26 @@ all_metrics = {
     "accuracy(r2)": lambda y, y_hat, var_y, tau: 1 - np.mean((y - y_hat) ** 2) / var_y >= tau,
 }
 
+
+def _mse(y, y_hat):
+    return np.mean((y - y_hat) ** 2)
+
+
+def _mse_grad(y, y_hat):
+    # gradient of the mean squared error w.r.t. y
+    return 2 * (y - y_hat) / y.size
+
+
+# gradient of the mse-based metrics w.r.t. the first argument `y`. used for exact gradients of the trajectory loss.
+all_metrics_grad = {
+    "neg_mse": lambda y, y_hat, var_y: -_mse_grad(y, y_hat),
+    "neg_rmse": lambda y, y_hat, var_y: -_mse_grad(y, y_hat) / (2 * np.sqrt(_mse(y, y_hat))),
+    "neg_nmse": lambda y, y_hat, var_y: -_mse_grad(y, y_hat) / var_y,
+    "log_nmse": lambda y, y_hat, var_y: -_mse_grad(y, y_hat) / (
+            var_y * (1e-60 + _mse(y, y_hat) / var_y) * np.log(10)),
+    "neg_nrmse": lambda y, y_hat, var_y: -_mse_grad(y, y_hat) / (2 * var_y * np.sqrt(_mse(y, y_hat) / var_y)),
+    "inv_mse": lambda y, y_hat, var_y: -_mse_grad(y, y_hat) / (1 + _mse(y, y_hat)) ** 2,
+    "inv_nmse": lambda y, y_hat, var_y: -_mse_grad(y, y_hat) / (var_y * (1 + _mse(y, y_hat) / var_y) ** 2),
+    "inv_nrmse": lambda y, y_hat, var_y: -_mse_grad(y, y_hat) / (
+            2 * var_y * np.sqrt(_mse(y, y_hat) / var_y) * (1 + np.sqrt(_mse(y, y_hat) / var_y)) ** 2),
+}
@@ -0,0 +1,107 @@
+"""process-wide LRU cache of the compiled candidate ODEs, keyed by their canonical skeleton."""
+import inspect
+import os
+import pickle
+import re
+from collections import OrderedDict
+
+import numpy as np
+from sympy import lambdify
+
+# float literals, as printed by sympy (e.g., 0.5, 1.0e-5). integers (e.g., the exponent in X0**2) are kept.
+FLOAT_LITERAL = re.compile(r'(?<![\w.])(\d+\.\d*(?:[eE][+-]?\d+)?|\d+[eE][+-]?\d+)')
+
+
+def canonical_skeleton(expr_strs: list):
+    """
+    abstract the float literals of the expressions to open constants c0, c1, ..., numbered in the order they appear.
+    expressions that only differ in their constants share the same skeleton, thus share the compiled code.
+    return the skeleton (tuple of strings), the names of the constants and their values.
+    """
+    c_values = []
+
+    def abstract(match):
+        c_values.append(float(match.group(0)))
+        return 'c' + str(len(c_values) - 1)
+
+    skeleton = tuple(FLOAT_LITERAL.sub(abstract, one_expr) for one_expr in expr_strs)
+    c_names = ['c' + str(i) for i in range(len(c_values))]
+    return skeleton, c_names, np.asarray(c_values, dtype=float)
+
+
+def rhs_source(num_function) -> str:
+    """the python source generated by lambdify for num_function."""
+    return inspect.getsource(num_function)
+
+
+def rhs_from_source(source: str):
+    """
+    rebuild a numpy function lambdified by sympy (or compiled from the expression tree, see `tree_source`) from its
+    source, without parsing and printing the expressions again.
+    """
+    # the namespace of a lambdified numpy function has all the numpy names used by the printer.
+    namespace = dict(lambdify((), 0).__globals__)
+    exec(source, namespace)
+    return namespace[re.search(r'^def (\w+)\(', source, re.MULTILINE).group(1)]
+
+
+class CompiledExpressionCache(object):
+    """
+    LRU cache from a key (the canonical skeleton of candidate ODEs and how they are simulated) to the compiled callable.
+    every entry may carry some metadata (e.g., the generated source code), which is what `save` persists: entries
+    loaded by `load` are rebuilt from their metadata on the first request, without going through sympy.
+    """
+
+    def __init__(self, maxsize=2048):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.metadata = {}
+        # metadata of the entries from the previous runs, not compiled yet.
+        self.persisted = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, build):
+        """
+        return the callable of key. on a miss, `build(metadata)` compiles it and returns (callable, metadata), where the
+        given metadata is the persisted one (None if the key is not persisted).
+        """
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.misses += 1
+        value, metadata = build(self.persisted.pop(key, None))
+        self.entries[key] = value
+        self.metadata[key] = metadata
+        if len(self.entries) > self.maxsize:
+            oldest, _ = self.entries.popitem(last=False)
+            self.metadata.pop(oldest, None)
+        return value
+
+    def clear(self):
+        self.entries.clear()
+        self.metadata.clear()
+        self.hits, self.misses = 0, 0
+
+    def cache_info(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'maxsize': self.maxsize, 'currsize': len(self.entries)}
+
+    def save(self, path):
+        """persist the metadata of the cached entries (the callables themselves are not picklable)."""
+        persisted = dict(self.persisted)
+        persisted.update({key: val for key, val in self.metadata.items() if val is not None})
+        with open(path, 'wb') as fw:
+            pickle.dump(persisted, fw)
+        print("saved {} compiled expressions to {}".format(len(persisted), path))
+
+    def load(self, path):
+        if not os.path.isfile(path):
+            return
+        with open(path, 'rb') as fr:
+            self.persisted.update(pickle.load(fr))
+        print("loaded {} compiled expressions from {}".format(len(self.persisted), path))
+
+
+# shared by execute and optimize within one process.
+compiled_expressions = CompiledExpressionCache()
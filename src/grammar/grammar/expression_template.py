@@ -0,0 +1,138 @@
+"""normalize the templates of candidate ODEs, where every C is an open constant."""
+import ast
+import re
+
+# an open constant in the template. C is never a non-terminal symbol, see `construct_non_terminal_nodes_and_start_symbols`.
+OPEN_CONSTANT = re.compile(r'\bC\b')
+
+
+def simplify_template(equations: list) -> list:
+    """
+    merge the redundant open constants of every template in one pass over its expression tree:
+    - a subtree without variables, but with some C, is one constant: (C+C), C*C, (C)/(C), exp(C), sin(C), 1/(C), ...
+    - the constant terms of a sum are one constant: (X0+C)+C => (C+X0), and so are the constant factors of a product:
+      C*(X0*C) => C*X0, (X0)/(C) => C*X0.
+    the output is a template with the same syntax, e.g. ['((X0+C))/(X1)', 'C*X0*X1'], so the optimizer only sees
+    independent constants. a template that can not be parsed (e.g., with a non-terminal symbol) is kept as it is.
+    """
+    new_equations = []
+    for eq in equations:
+        try:
+            tree = _to_template_tree(ast.parse(eq, mode='eval').body)
+        except (SyntaxError, NotImplementedError):
+            new_equations.append(eq)
+            continue
+        new_equations.append(_print_template_tree(_fold_constants(tree)))
+    return new_equations
+
+
+def number_constants(equations: list, name_format='c{}') -> tuple:
+    """
+    replace the open constants C of the templates by name_format.format(0), name_format.format(1), ..., numbered in the
+    order they appear, in one pass over all the equations.
+    return the numbered equations and the names of the constants.
+    """
+    c_names = []
+
+    def number(match):
+        c_names.append(name_format.format(len(c_names)))
+        return c_names[-1]
+
+    return [OPEN_CONSTANT.sub(number, eq) for eq in equations], c_names
+
+
+def substitute_constants(equations: list, c_names: list, c_values) -> list:
+    """
+    replace the named constants (see `number_constants`) by their values, in one pass over every equation.
+    the values below 1e-5 in magnitude are replaced by 0.
+    """
+    values = {ci: str(0 if abs(est_c) < 1e-5 else float(est_c)) for ci, est_c in zip(c_names, c_values)}
+    named = re.compile(r'\b(?:' + '|'.join(re.escape(ci) for ci in c_names) + r')\b')
+    return [named.sub(lambda match: values[match.group(0)], eq) for eq in equations]
+
+
+# the expression tree of a template is made of tuples:
+# ('C',), ('num', '2'), ('var', 'X0'), ('call', 'exp', [args]), ('call', '**', [base, exponent]),
+# ('add', [(is_negated, term), ...]), ('mul', [(is_inverted, factor), ...])
+_CONSTANT = ('C',)
+
+
+def _to_template_tree(node):
+    if isinstance(node, ast.Name):
+        return _CONSTANT if node.id == 'C' else ('var', node.id)
+    elif isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+        return ('num', repr(node.value))
+    elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and not node.keywords:
+        return ('call', node.func.id, [_to_template_tree(arg) for arg in node.args])
+    elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        return ('mul', [(False, ('num', '-1')), (False, _to_template_tree(node.operand))])
+    elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.UAdd):
+        return _to_template_tree(node.operand)
+    elif isinstance(node, ast.BinOp) and isinstance(node.op, (ast.Add, ast.Sub)):
+        # flatten the chain of sums, e.g. (A-(B+C)) => [A, -B, -C]
+        left, right = _to_template_tree(node.left), _to_template_tree(node.right)
+        is_sub = isinstance(node.op, ast.Sub)
+        return ('add', _flatten('add', left, False) + _flatten('add', right, is_sub))
+    elif isinstance(node, ast.BinOp) and isinstance(node.op, (ast.Mult, ast.Div)):
+        left, right = _to_template_tree(node.left), _to_template_tree(node.right)
+        is_div = isinstance(node.op, ast.Div)
+        return ('mul', _flatten('mul', left, False) + _flatten('mul', right, is_div))
+    elif isinstance(node, ast.BinOp) and isinstance(node.op, ast.Pow):
+        # folded like a call, printed back as a power.
+        return ('call', '**', [_to_template_tree(node.left), _to_template_tree(node.right)])
+    raise NotImplementedError(ast.dump(node), "is not implemented....")
+
+
+def _flatten(kind, tree, flipped):
+    if tree[0] != kind:
+        return [(flipped, tree)]
+    return [(flipped != sub_flipped, sub_tree) for sub_flipped, sub_tree in tree[1]]
+
+
+def _fold_constants(tree):
+    """
+    fold the constant subtrees bottom-up. return the folded tree, which is _CONSTANT if the subtree has no variable and
+    at least one open constant.
+    """
+    kind = tree[0]
+    if kind == 'call':
+        args = [_fold_constants(arg) for arg in tree[2]]
+        if _CONSTANT in args and all(arg == _CONSTANT or arg[0] == 'num' for arg in args):
+            return _CONSTANT
+        return ('call', tree[1], args)
+    elif kind in ('add', 'mul'):
+        children = [(flipped, _fold_constants(sub_tree)) for flipped, sub_tree in tree[1]]
+        if not any(sub_tree == _CONSTANT for _, sub_tree in children):
+            return (kind, children)
+        # one open constant absorbs all the other constants and numbers of the same sum (product).
+        rest = [(flipped, sub_tree) for flipped, sub_tree in children if sub_tree != _CONSTANT and sub_tree[0] != 'num']
+        if not rest:
+            return _CONSTANT
+        return (kind, [(False, _CONSTANT)] + rest)
+    return tree
+
+
+def _print_template_tree(tree) -> str:
+    kind = tree[0]
+    if kind == 'C':
+        return 'C'
+    elif kind in ('num', 'var'):
+        return tree[1]
+    elif kind == 'call' and tree[1] == '**':
+        return '({})**({})'.format(*(_print_template_tree(arg) for arg in tree[2]))
+    elif kind == 'call':
+        return '{}({})'.format(tree[1], ', '.join(_print_template_tree(arg) for arg in tree[2]))
+    elif kind == 'add':
+        # a sum is always printed in parentheses, so it is safe as an operand.
+        out = ''
+        for is_negated, term in tree[1]:
+            out += ('-' if is_negated else '+' if out else '') + _print_template_tree(term)
+        return '(' + out + ')'
+    # product, whose factors are never products themselves.
+    numerator = [_print_template_tree(factor) for is_inverted, factor in tree[1] if not is_inverted]
+    denominator = [_print_template_tree(factor) for is_inverted, factor in tree[1] if is_inverted]
+    if not denominator:
+        return '*'.join(numerator)
+    elif numerator in ([], ['1']):
+        return '1/({})'.format('*'.join(denominator))
+    return '({})/({})'.format('*'.join(numerator), '*'.join(denominator))
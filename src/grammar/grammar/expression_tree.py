@@ -0,0 +1,331 @@
+"""
+a light expression tree of the candidate ODEs, built from the production rules (or the expression strings) without
+sympy, with a printer of templates, a canonical form for deduplication, a vectorized numpy evaluator and a compiler to
+python functions.
+
+the nodes are tuples:
+('var', i): the i-th input variable Xi.
+('const', j): the j-th open constant.
+('num', value): a fixed number.
+('add', a, b), ('sub', a, b), ('mul', a, b), ('div', a, b), ('pow', a, b), ('neg', a)
+('exp', a), ('log', a), ('sqrt', a), ('sin', a), ('cos', a), ('tan', a), ('cot', a), ('abs', a)
+('hole', symbol): a non-terminal symbol, only in the right-hand side of the production rules.
+"""
+import ast
+import re
+from functools import lru_cache
+
+import numpy as np
+
+from grammar.production_rules import concate_production_rules_to_expr
+
+BINARY_OPS = {ast.Add: 'add', ast.Sub: 'sub', ast.Mult: 'mul', ast.Div: 'div', ast.Pow: 'pow'}
+FUNCTIONS = {'exp': 'exp', 'log': 'log', 'sqrt': 'sqrt', 'sin': 'sin', 'cos': 'cos', 'tan': 'tan', 'cot': 'cot',
+             'Abs': 'abs', 'abs': 'abs', 'power': 'pow'}
+# the names sympy prints for some numbers.
+NAMED_NUMBERS = {'E': np.e, 'pi': np.pi, 'oo': np.inf, 'zoo': np.nan, 'nan': np.nan}
+
+NUMPY_FUNCTIONS = {
+    'add': np.add, 'sub': np.subtract, 'mul': np.multiply, 'div': np.divide, 'pow': np.power, 'neg': np.negative,
+    'exp': np.exp, 'log': np.log, 'sqrt': np.sqrt, 'sin': np.sin, 'cos': np.cos, 'tan': np.tan,
+    'cot': lambda a: 1 / np.tan(a), 'abs': np.abs,
+}
+# the syntax of the templates, see `tree_to_template`. all but the products are parenthesized, so every operand is safe.
+TEMPLATE_FORMATS = {
+    'add': '({}+{})', 'sub': '({}-{})', 'mul': '{}*{}', 'div': '({})/({})', 'pow': '({})**({})', 'neg': '(-{})',
+    'exp': 'exp({})', 'log': 'log({})', 'sqrt': 'sqrt({})', 'sin': 'sin({})', 'cos': 'cos({})', 'tan': 'tan({})',
+    'cot': 'cot({})', 'abs': 'Abs({})',
+}
+SOURCE_FORMATS = {
+    'add': '({} + {})', 'sub': '({} - {})', 'mul': '{} * {}', 'div': '{} / {}', 'pow': '{} ** {}', 'neg': '(-{})',
+    'exp': 'numpy.exp({})', 'log': 'numpy.log({})', 'sqrt': 'numpy.sqrt({})', 'sin': 'numpy.sin({})',
+    'cos': 'numpy.cos({})', 'tan': 'numpy.tan({})', 'cot': '(1 / numpy.tan({}))', 'abs': 'numpy.abs({})',
+}
+
+
+def tree_from_str(expr_str: str, var_names: list, const_names=(), holes=()):
+    """
+    build the tree of one expression string, e.g. "C*X0**2 - exp(X1)".
+    var_names, const_names: the names of the input variables and the open constants, in order.
+    holes: the non-terminal symbols (see `tree_from_rules`).
+    raise ValueError for a name or a function that is not one of them.
+    """
+    try:
+        node = ast.parse(expr_str, mode='eval').body
+    except SyntaxError as e:
+        raise ValueError(expr_str, "is not an expression") from e
+    return _from_ast(node, {name: i for i, name in enumerate(var_names)},
+                     {name: j for j, name in enumerate(const_names)}, set(holes))
+
+
+def _from_ast(node, var_idx, const_idx, holes):
+    if isinstance(node, ast.BinOp) and type(node.op) in BINARY_OPS:
+        return (BINARY_OPS[type(node.op)], _from_ast(node.left, var_idx, const_idx, holes),
+                _from_ast(node.right, var_idx, const_idx, holes))
+    elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        return ('neg', _from_ast(node.operand, var_idx, const_idx, holes))
+    elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.UAdd):
+        return _from_ast(node.operand, var_idx, const_idx, holes)
+    elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS \
+            and not node.keywords:
+        return (FUNCTIONS[node.func.id],) + tuple(_from_ast(arg, var_idx, const_idx, holes) for arg in node.args)
+    elif isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+        return ('num', float(node.value))
+    elif isinstance(node, ast.Name) and node.id in var_idx:
+        return ('var', var_idx[node.id])
+    elif isinstance(node, ast.Name) and node.id in const_idx:
+        return ('const', const_idx[node.id])
+    elif isinstance(node, ast.Name) and node.id in holes:
+        return ('hole', node.id)
+    elif isinstance(node, ast.Name) and node.id in NAMED_NUMBERS:
+        return ('num', NAMED_NUMBERS[node.id])
+    raise ValueError(ast.dump(node), "is not supported by the expression tree")
+
+
+@lru_cache(maxsize=1024)
+def _rule_tree(rule: str, nvars: int, holes: tuple):
+    # right-hand side of one production rule, where "C" is an open constant numbered later.
+    return tree_from_str(rule.split('->', 1)[1], ['X' + str(i) for i in range(nvars)], ['C'], holes)
+
+
+def tree_from_rules(list_of_rules: list, nvars: int, non_terminal_nodes: list) -> list:
+    """
+    build the trees of the ODEs directly from the production rules, e.g. ['f||g->A||B', 'A->(A+A)', 'A->X0', ...].
+    like `concate_production_rules_to_expr`, every rule of a symbol replaces the leftmost pending one of its expression.
+    the open constants are numbered from left to right over all the expressions, the same as `number_constants`.
+    raise ValueError if a non-terminal symbol is left.
+    """
+    holes = tuple(non_terminal_nodes)
+    _, right_symbols = list_of_rules[0].split("->")
+    pending = {symbol: [] for symbol in right_symbols.split("||")}
+    for one_rule in list_of_rules[1:]:
+        pending[one_rule[0]].append(one_rule)
+    num_consts = [0]
+
+    def expand(tree, rules_iter):
+        kind = tree[0]
+        if kind == 'hole':
+            one_rule = next(rules_iter, None)
+            if one_rule is None:
+                raise ValueError(tree[1], "is left in the expression")
+            return expand(_rule_tree(one_rule, nvars, holes), rules_iter)
+        elif kind == 'const':
+            num_consts[0] += 1
+            return ('const', num_consts[0] - 1)
+        elif kind in ('var', 'num'):
+            return tree
+        return (kind,) + tuple(expand(child, rules_iter) for child in tree[1:])
+
+    return [expand(('hole', symbol), iter(pending[symbol])) for symbol in right_symbols.split("||")]
+
+
+def rules_to_templates(list_of_rules: list) -> list:
+    """
+    the templates of the ODEs built by the production rules, printed from their trees (see `tree_from_rules`), e.g.
+    ['f||f->A||B', 'A->C*X0', 'B->(B+B)', 'B->X0', 'B->X1'] => ['C*X0', '(X0+X1)'].
+    every ODE has its own non-terminal symbol in the start rule, and there is one ODE per variable.
+    the rules that leave a non-terminal symbol (or that the tree does not support) are spliced as strings by
+    `concate_production_rules_to_expr` instead.
+    """
+    symbols = list_of_rules[0].split('->')[1].split('||')
+    try:
+        trees = tree_from_rules(list_of_rules, len(symbols), symbols)
+    except ValueError:
+        return concate_production_rules_to_expr(list_of_rules)
+    return [tree_to_template(tree) for tree in trees]
+
+
+def tree_to_template(tree) -> str:
+    """
+    print the tree as a template, where every open constant is C, e.g. "(C*X0+exp(X1))". the template is python syntax,
+    which `tree_from_str` and `expression_template.simplify_template` read back.
+    """
+    kind = tree[0]
+    if kind == 'var':
+        return 'X' + str(tree[1])
+    elif kind == 'const':
+        return 'C'
+    elif kind == 'num':
+        return repr(int(tree[1]) if tree[1].is_integer() and abs(tree[1]) < 2 ** 53 else tree[1])
+    elif kind == 'hole':
+        return tree[1]
+    elif kind == 'pow' and all(child[0] in ('var', 'const') or child[0] == 'num' and child[1] >= 0
+                               for child in tree[1:]):
+        # e.g., X0**2, the same as the rules.
+        return '{}**{}'.format(*(tree_to_template(child) for child in tree[1:]))
+    return TEMPLATE_FORMATS[kind].format(*(tree_to_template(child) for child in tree[1:]))
+
+
+def canonical_tree(tree):
+    """
+    the canonical form of the tree, for hashing and deduplication: the chains of sums (and products) are flattened and
+    their operands sorted, e.g., (X0+(X2-X1)) and ((X2+X0)-X1) share the canonical tree. nothing is simplified.
+    sums are ('add', ((is_negated, term), ...)) and products ('mul', ((is_inverted, factor), ...)).
+    """
+    kind = tree[0]
+    if kind in ('add', 'sub', 'neg'):
+        return ('add', tuple(sorted(_flatten_terms(tree, False), key=repr)))
+    elif kind in ('mul', 'div'):
+        return ('mul', tuple(sorted(_flatten_factors(tree, False), key=repr)))
+    elif kind in ('var', 'const', 'num', 'hole'):
+        return tree
+    return (kind,) + tuple(canonical_tree(child) for child in tree[1:])
+
+
+def _flatten_terms(tree, negated):
+    kind = tree[0]
+    if kind == 'add':
+        return _flatten_terms(tree[1], negated) + _flatten_terms(tree[2], negated)
+    elif kind == 'sub':
+        return _flatten_terms(tree[1], negated) + _flatten_terms(tree[2], not negated)
+    elif kind == 'neg':
+        return _flatten_terms(tree[1], not negated)
+    return [(negated, canonical_tree(tree))]
+
+
+def _flatten_factors(tree, inverted):
+    kind = tree[0]
+    if kind == 'mul':
+        return _flatten_factors(tree[1], inverted) + _flatten_factors(tree[2], inverted)
+    elif kind == 'div':
+        return _flatten_factors(tree[1], inverted) + _flatten_factors(tree[2], not inverted)
+    return [(inverted, canonical_tree(tree))]
+
+
+def offset_variables(tree, offset: int):
+    """the same tree, where the variable Xi is X(i + offset). used to stack many candidates into one state."""
+    kind = tree[0]
+    if kind == 'var':
+        return ('var', tree[1] + offset)
+    elif kind in ('const', 'num', 'hole'):
+        return tree
+    return (kind,) + tuple(offset_variables(child, offset) for child in tree[1:])
+
+
+def offset_constants(tree, offset: int):
+    """the same tree, where the constant cj is c(j + offset). used to stack the constants of many candidates."""
+    kind = tree[0]
+    if kind == 'const':
+        return ('const', tree[1] + offset)
+    elif kind in ('var', 'num', 'hole'):
+        return tree
+    return (kind,) + tuple(offset_constants(child, offset) for child in tree[1:])
+
+
+def has_constants(tree) -> bool:
+    if tree[0] == 'const':
+        return True
+    elif tree[0] in ('var', 'num', 'hole'):
+        return False
+    return any(has_constants(child) for child in tree[1:])
+
+
+def linear_in_constants(tree):
+    """
+    write the tree as g + c0 * g0 + c1 * g1 + ..., where no g has a constant.
+    return the dict {None: g, 0: g0, 1: g1, ...} (the missing terms are 0), or None if the tree is not linear in its
+    constants, e.g., exp(c0 * X0) or c0 * c1 * X0.
+    """
+    kind = tree[0]
+    if not has_constants(tree):
+        return {None: tree}
+    elif kind == 'const':
+        return {tree[1]: ('num', 1.0)}
+    elif kind in ('add', 'sub'):
+        left, right = linear_in_constants(tree[1]), linear_in_constants(tree[2])
+        if left is None or right is None:
+            return None
+        terms = dict(left)
+        for k, g in right.items():
+            g = g if kind == 'add' else ('neg', g)
+            terms[k] = ('add', terms[k], g) if k in terms else g
+        return terms
+    elif kind == 'neg':
+        terms = linear_in_constants(tree[1])
+        return None if terms is None else {k: ('neg', g) for k, g in terms.items()}
+    elif kind in ('mul', 'div'):
+        # one side (the denominator, for a division) has to be free of constants.
+        if not has_constants(tree[2]):
+            terms = linear_in_constants(tree[1])
+            return None if terms is None else {k: (kind, g, tree[2]) for k, g in terms.items()}
+        elif kind == 'mul' and not has_constants(tree[1]):
+            terms = linear_in_constants(tree[2])
+            return None if terms is None else {k: ('mul', tree[1], g) for k, g in terms.items()}
+    return None
+
+
+def evaluate_tree(tree, X, c=()):
+    """
+    evaluate the tree on a batch of states at once.
+    X: [nvars, batch_size], c: values of the open constants.
+    """
+    kind = tree[0]
+    if kind == 'var':
+        return X[tree[1]]
+    elif kind == 'const':
+        return c[tree[1]]
+    elif kind == 'num':
+        return tree[1]
+    elif kind == 'hole':
+        raise ValueError(tree[1], "is left in the expression")
+    return NUMPY_FUNCTIONS[kind](*(evaluate_tree(child, X, c) for child in tree[1:]))
+
+
+def tree_source(trees: list, nvars: int, nconsts: int, name='rhs') -> str:
+    """
+    python source of `name(t, X0, X1, ..., c0, c1, ...)`, which returns the list of the expressions. the same as the
+    function lambdified by sympy from the expressions. the subtrees shared by the expressions are computed once.
+    """
+    counts = {}
+    for tree in trees:
+        _count_subtrees(tree, counts)
+    args = ['t'] + ['X' + str(i) for i in range(nvars)] + ['c' + str(j) for j in range(nconsts)]
+    lines = ['def {}({}):'.format(name, ', '.join(args))]
+    names = {}
+    outputs = [_tree_source(tree, counts, names, lines) for tree in trees]
+    lines.append('    return [{}]'.format(', '.join(outputs)))
+    return '\n'.join(lines)
+
+
+def _count_subtrees(tree, counts):
+    if tree[0] in ('var', 'const', 'num'):
+        return
+    counts[tree] = counts.get(tree, 0) + 1
+    if counts[tree] == 1:
+        for child in tree[1:]:
+            _count_subtrees(child, counts)
+
+
+def _tree_source(tree, counts, names, lines):
+    kind = tree[0]
+    if kind == 'var':
+        return 'X' + str(tree[1])
+    elif kind == 'const':
+        return 'c' + str(tree[1])
+    elif kind == 'num' and not np.isfinite(tree[1]):
+        return 'numpy.float64({!r})'.format(str(tree[1]))
+    elif kind == 'num':
+        # integers are printed as integers, e.g., X0**2, the same as sympy.
+        return '({!r})'.format(int(tree[1]) if tree[1].is_integer() and abs(tree[1]) < 2 ** 53 else tree[1])
+    elif kind == 'hole':
+        raise ValueError(tree[1], "is left in the expression")
+    elif tree in names:
+        return names[tree]
+    out = SOURCE_FORMATS[kind].format(*(_tree_source(child, counts, names, lines) for child in tree[1:]))
+    if counts.get(tree, 0) > 1:
+        names[tree] = '_t' + str(len(names))
+        lines.append('    {} = {}'.format(names[tree], out))
+        return names[tree]
+    return '(' + out + ')' if kind in ('mul', 'div', 'pow') else out
+
+
+def compile_source(source: str):
+    """compile the source of `tree_source` into the python function."""
+    namespace = {'numpy': np}
+    exec(source, namespace)
+    return namespace[re.match(r'def (\w+)\(', source).group(1)]
+
+
+def compile_trees(trees: list, nvars: int, nconsts: int = 0):
+    """the function `f(t, X0, X1, ..., c0, c1, ...)` of the trees, see `tree_source`."""
+    return compile_source(tree_source(trees, nvars, nconsts))
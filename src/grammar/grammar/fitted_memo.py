@@ -0,0 +1,86 @@
+"""memo of the fitted candidate ODEs across epochs, keyed by their normalized template."""
+from collections import OrderedDict
+
+import numpy as np
+
+
+def data_fingerprint(init_cond, t_eval) -> int:
+    """identify the set of initial conditions (and time steps) the candidates are fitted on."""
+    return hash((np.asarray(init_cond).tobytes(), np.asarray(t_eval).tobytes()))
+
+
+class FittedExpressionMemo(object):
+    """
+    store the last fitted constants, train_loss and fitted equations of every template, together with the fingerprint of
+    the data they were fitted on. a repeated template either reuses the stored result (same data, "exact" hit), or is
+    re-fitted from the stored constants with a few iterations (new data, "warm" hit).
+
+    capacity: the maximum number of templates in the memo.
+    eviction: which entry to drop once the memo is full.
+    - "lru": the least recently used template.
+    - "fifo": the oldest stored template.
+    - "worst": the template with the lowest train_loss, so the good candidates stay.
+    """
+
+    def __init__(self, capacity=1000, eviction='lru'):
+        if eviction not in ['lru', 'fifo', 'worst']:
+            raise NotImplementedError(eviction, "is not implemented....")
+        self.capacity = capacity
+        self.eviction = eviction
+        self.entries = OrderedDict()
+        self.counts = {'exact': 0, 'warm': 0, 'miss': 0}
+        # the candidates counted since the last report, see `lookup`.
+        self.counted = set()
+
+    def lookup(self, key, data_key, candidate=None):
+        """
+        return ("exact", entry), ("warm", entry) or ("miss", None) for the template key on the data data_key.
+        candidate: what the lookup is counted for (key if None). a candidate looked up again before the next report
+                   (e.g., re-fitted on the rungs of successive halving, or re-fitted after screening) is counted once,
+                   by its first lookup.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            status = 'miss'
+        elif entry['data_key'] == data_key:
+            status = 'exact'
+        else:
+            status = 'warm'
+        if entry is not None and self.eviction == 'lru':
+            self.entries.move_to_end(key)
+        candidate = key if candidate is None else candidate
+        if candidate not in self.counted:
+            self.counted.add(candidate)
+            self.counts[status] += 1
+        return status, entry
+
+    def store(self, key, data_key, constants, train_loss, fitted_eq):
+        if self.capacity <= 0:
+            return
+        self.entries.pop(key, None)
+        self.entries[key] = {'data_key': data_key, 'constants': np.atleast_1d(np.asarray(constants, dtype=float)),
+                             'train_loss': train_loss, 'fitted_eq': fitted_eq}
+        while len(self.entries) > self.capacity:
+            if self.eviction == 'worst':
+                worst = min(self.entries, key=lambda k: _finite_or_neg_inf(self.entries[k]['train_loss']))
+                del self.entries[worst]
+            else:
+                self.entries.popitem(last=False)
+
+    def report_and_reset(self):
+        """print the hit rates since the last call (i.e., of one epoch) and reset the counters."""
+        total = sum(self.counts.values())
+        if total > 0:
+            print("fitted memo: {} exact hits, {} warm starts, {} misses of {} candidates "
+                  "(hit rate {:.3f}), size {}/{}".format(self.counts['exact'], self.counts['warm'],
+                                                       self.counts['miss'], total,
+                                                       (self.counts['exact'] + self.counts['warm']) / total,
+                                                       len(self.entries), self.capacity))
+        self.counts = {'exact': 0, 'warm': 0, 'miss': 0}
+        self.counted = set()
+
+
+def _finite_or_neg_inf(train_loss):
+    if train_loss is None or not np.isfinite(train_loss):
+        return -np.inf
+    return train_loss
@@ -1,9 +1,14 @@
+import copy
+
 import numpy as np
 from sympy import Symbol
 import scipy
 from grammar.grammar_program import SymbolicDifferentialEquations
-from grammar.minimize_coefficients import execute
+from grammar.minimize_coefficients import execute, execute_many
 from grammar.act_sampling import compute_disagreement_score
+from grammar.expression_template import simplify_template
+from grammar.expression_tree import rules_to_templates
+from grammar.utils import canonical_form
 
 
 class ContextFreeGrammar(object):
@@ -119,22 +124,62 @@ class ContextFreeGrammar(object):
             one_list_of_rules = self.complete_rules(one_seq_of_rules)
             filtered_many_rules.append(one_list_of_rules)
             # print("pruned list_of_rules:", one_list_of_rules)
+        # many sequences collapse to the same expression: fit every distinct one once, and share the fit.
+        unique_many_rules, inverse = self.deduplicate_rules(filtered_many_rules)
+        print(f"{len(unique_many_rules)} distinct expressions in {len(filtered_many_rules)} sequences of rules")
+        # one epoch starts here; within it the oracle answers repeated queries from its cache.
+        self.task.reset_trajectory_cache()
         self.task.rand_draw_init_cond()
         true_trajectories = self.task.evaluate()
         many_expressions = []
         if self.program.n_cores == 1:
             many_expressions = self.program.fitting_new_expressions(
-                filtered_many_rules,
+                unique_many_rules,
                 self.task.init_cond, self.task.time_span, self.task.t_evals,
                 true_trajectories,
                 self.input_var_Xs)
         elif self.program.n_cores > 1:
             many_expressions = self.program.fitting_new_expressions_in_parallel(
-                filtered_many_rules,
+                unique_many_rules,
                 self.task.init_cond, self.task.time_span, self.task.t_evals,
                 true_trajectories,
                 self.input_var_Xs)
-        return many_expressions
+        if self.program.fitted_memo is not None:
+            self.program.fitted_memo.report_and_reset()
+        if self.program.derivative_prefit:
+            self.program.report_prefit(many_expressions)
+        if self.program.time_budget is not None or self.program.eval_budget is not None:
+            self.program.report_budgets(many_expressions)
+        # one expression per sequence, so every sample gets its reward. the duplicates are copies of the fitted
+        # expression with their own sequence of rules, so every sample is still validated on its own.
+        sampled_expressions = []
+        for one_list_of_rules, j in zip(filtered_many_rules, inverse):
+            one_expression = copy.copy(many_expressions[j])
+            one_expression.traversal = one_list_of_rules
+            sampled_expressions.append(one_expression)
+        return sampled_expressions
+
+    def expression_key(self, list_of_rules) -> tuple:
+        """
+        canonical key of the expressions built by the rules: the canonical form of the normalized template (so, e.g.,
+        (X0+X1) and (X1+X0) share the key), see `utils.canonical_form`. after the normalization every open constant
+        is independent, so two sequences with the same key are the same function of the constants and the variables.
+        """
+        templates = simplify_template(rules_to_templates(list_of_rules))
+        return canonical_form(templates, [str(xi) for xi in self.input_var_Xs])
+
+    def deduplicate_rules(self, many_rules):
+        """
+        return the distinct sequences of rules (by `expression_key`), and for each sequence the index of its distinct one.
+        """
+        unique_rules, inverse, positions = [], [], {}
+        for one_list_of_rules in many_rules:
+            key = self.expression_key(one_list_of_rules)
+            if key not in positions:
+                positions[key] = len(unique_rules)
+                unique_rules.append(one_list_of_rules)
+            inverse.append(positions[key])
+        return unique_rules, inverse
 
     def expression_active_evaluation(self, many_expressions, active_mode='phase_portrait',
                                      full_mesh_size=1,
@@ -154,19 +199,20 @@ class ContextFreeGrammar(object):
         elif active_mode == 'full':
             init_cond = self.task.full_init_cond(full_mesh_size)
             self.task.init_cond = init_cond
+        # integrate all the valid expressions together on the validation data. the same equations only once.
+        unique, inverse = unique_expressions(many_expressions)
+        valid_idx = [i for i, one_expression in enumerate(unique)
+                     if one_expression.train_loss is not None and one_expression.train_loss != -np.inf]
+        many_pred_trajectories = execute_many([unique[i].fitted_eq for i in valid_idx],
+                                              init_cond, self.task.time_span, self.task.t_evals,
+                                              self.input_var_Xs, **self.program.integrator_kwargs)
+        pred_trajectories_of = dict(zip(valid_idx, many_pred_trajectories))
+        # but every expression is scored on its own, with its own draw of the dropped time steps.
+        for one_expression, i in zip(many_expressions, inverse):
+            one_expression.valid_loss = -np.inf
+            if i in pred_trajectories_of:
+                one_expression.valid_loss = self.task.evaluate_loss(pred_trajectories_of[i])
         for one_expression in many_expressions:
-            if one_expression.train_loss is not None and one_expression.train_loss != -np.inf:
-
-                pred_trajectories = execute(one_expression.fitted_eq,
-                                            init_cond, self.task.time_span, self.task.t_evals,
-                                            self.input_var_Xs)
-                if pred_trajectories is None or len(pred_trajectories) == 0:
-                    one_expression.valid_loss = -np.inf
-                else:
-                    one_expression.valid_loss = self.task.evaluate_loss(pred_trajectories)
-
-            else:
-                one_expression.valid_loss = -np.inf
             print("valid_loss:", one_expression.valid_loss, "Eq:", one_expression)
         return many_expressions
 
@@ -185,14 +231,14 @@ class ContextFreeGrammar(object):
         disagree_score = -1
         most_disagreed_init_conds = []
         selected = None
+        unique_odes, inverse = unique_expressions(list_of_odes)
         for region_i in list_of_regions:
-            phase_portait_in_region = []
             batch_drawed_inits = self.task.rand_draw_init_cond(num_init_cond_each_region, region_i)
-            for one_ode in list_of_odes:
-                phase_portait_in_region.append(execute(one_ode.fitted_eq,
-                                                       batch_drawed_inits, self.task.time_span, self.task.t_evals,
-                                                       self.input_var_Xs))
-            phase_portait_in_region = np.asarray(phase_portait_in_region).reshape(len(list_of_odes), -1)
+            # the shared expressions are simulated once, then repeated, so the score is the same as without sharing.
+            phase_portait_in_region = execute_many([one_ode.fitted_eq for one_ode in unique_odes],
+                                                   batch_drawed_inits, self.task.time_span, self.task.t_evals,
+                                                   self.input_var_Xs, **self.program.integrator_kwargs)[inverse]
+            phase_portait_in_region = phase_portait_in_region.reshape(len(list_of_odes), -1)
             cur_disagreement_score = compute_disagreement_score(phase_portait_in_region, self.program.metric_name)
             print("region={}, disagreement_score={}".format(region_i, cur_disagreement_score))
             if cur_disagreement_score > disagree_score:
@@ -236,7 +282,7 @@ class ContextFreeGrammar(object):
 
                     pred_trajectories = execute(pr.fitted_eq,
                                                 self.task.init_cond, self.task.time_span, self.task.t_evals,
-                                                self.input_var_Xs)
+                                                self.input_var_Xs, **self.program.integrator_kwargs)
                     dict_of_result = self.task.evaluate_all_losses(pred_trajectories)
 
                     if verbose:
@@ -249,3 +295,22 @@ class ContextFreeGrammar(object):
             else:
                 print('        ', pr, end="\n")
         print("=" * 20)
+
+
+def unique_expressions(many_expressions):
+    """
+    the expressions of many_expressions with distinct fitted equations (e.g., the copies made by
+    `ContextFreeGrammar.construct_expression`), and for each expression the index of its distinct one.
+    the expressions that are not fitted are all distinct.
+    """
+    unique, inverse, positions = [], [], {}
+    for one_expression in many_expressions:
+        if one_expression.fitted_eq is None:
+            key = id(one_expression)
+        else:
+            key = tuple(one_expression.fitted_eq)
+        if key not in positions:
+            positions[key] = len(unique)
+            unique.append(one_expression)
+        inverse.append(positions[key])
+    return unique, inverse
@@ -1,19 +1,33 @@
 """optimize coefficients in the symbolic expression."""
-from itertools import chain
+import ast
+import os
 import sys
+import time
 import numpy as np
 import warnings
 
-from grammar.production_rules import concate_production_rules_to_expr
-from grammar.evaluation_metrics import all_metrics
+from grammar.expression_tree import rules_to_templates
+from grammar.evaluation_metrics import all_metrics, all_metrics_grad
 
 from pathos.multiprocessing import ProcessPool
+from multiprocess import TimeoutError as PoolTimeoutError
 
-from grammar.minimize_coefficients import optimize
+from grammar.minimize_coefficients import optimize, optimize_many, optimize_population, execute
+from grammar.expression_template import simplify_template, OPEN_CONSTANT
+from grammar.fitted_memo import FittedExpressionMemo, data_fingerprint
+from grammar.shared_oracle import SharedOracle, attach_oracle
+from grammar.expression_cache import compiled_expressions
 from sympy.parsing.sympy_parser import parse_expr
 warnings.filterwarnings("ignore", category=RuntimeWarning)
 np.set_printoptions(precision=4, linewidth=np.inf)
 
+# with a time budget, a worker is killed once its task runs longer than WORKER_KILL_FACTOR times the time budget of its
+# candidates plus WORKER_KILL_GRACE seconds (for compiling, simulating and printing the fitted candidates). the pool is
+# checked every WATCHDOG_INTERVAL seconds.
+WORKER_KILL_FACTOR = 2.0
+WORKER_KILL_GRACE = 10.0
+WATCHDOG_INTERVAL = 1.0
+
 
 class SymbolicDifferentialEquations(object):
     """
@@ -23,16 +37,25 @@ class SymbolicDifferentialEquations(object):
 
     def __init__(self, list_of_rules):
         self.traversal = list_of_rules
-        self.expr_template = concate_production_rules_to_expr(list_of_rules)
+        self.expr_template = rules_to_templates(list_of_rules)
         self.valid_loss = None
         self.train_loss = None
         self.fitted_eq = None
         self.invalid = False
         self.all_metrics = None
+        # the floating point precision in which train_loss was computed.
+        self.loss_precision = None
+        # the fitted open constants, and the constants to start fitting from (see `grammarProgram.fitted_memo`).
+        self.fitted_constants = None
+        self.warm_constants = None
+        # "sufficient", "refined" or "failed", if the constants were pre-fitted (see `grammarProgram.derivative_prefit`).
+        self.prefit_status = None
+        # None, or why the fit was stopped: "time_budget", "eval_budget" or "killed" (see `grammarProgram.time_budget`).
+        self.stop_reason = None
 
     def __repr__(self):
-        return " train_loss={:.14f}\t valid_loss={:.14f}\t Eq=[{}]".format(
-            self.train_loss, self.valid_loss, ",\t ".join(self.fitted_eq))
+        return " train_loss={:.14f}\t valid_loss={:.14f}\t precision={}\t Eq=[{}]".format(
+            self.train_loss, self.valid_loss, self.loss_precision, ",\t ".join(self.fitted_eq))
 
     def print_all_metrics(self):
         print('-' * 30)
@@ -51,9 +74,46 @@ class grammarProgram(object):
     """
 
     def __init__(self, non_terminal_nodes, optimizer="BFGS", metric_name='neg_mse', max_opt_iter=500, n_cores=1,
-                 max_open_constants=20):
+                 max_open_constants=20, integrator_backend='numpy', integrator_method='rk4',
+                 divergence_threshold=None, use_sensitivity=False, screening_precision=None, refit_fraction=0.2,
+                 memo_capacity=0, memo_eviction='lru', memo_refine_iters=10, linear_fit_iters=None,
+                 derivative_prefit=False, n_starts=1, schedule='dynamic', schedule_chunk_size=1,
+                 time_budget=None, eval_budget=None, halving_rounds=0, halving_eta=3):
         """
         max_open_constants: the maximum number of allowed open constants in the expression.
+        integrator_backend: 'numpy', 'numba' or 'torch'. the integrator used to simulate the candidate ODEs.
+                            with 'torch', all the candidates of one call are fitted together with autograd, and the
+                            optimizer is 'Adam' or 'LBFGS'.
+                            with 'numpy' and 'rk4', the optimizer 'differential_evolution' fits the candidates with the
+                            same number of constants together, see `minimize_coefficients.optimize_population`.
+                            linear_fit_iters, derivative_prefit, n_starts and the budgets do not apply to the
+                            candidates fitted together.
+        integrator_method: 'rk4', 'euler' (numba only) or 'rk45' (numpy only).
+        divergence_threshold: stop simulating a candidate once its state exceeds this magnitude. None to disable.
+        use_sensitivity: integrate the forward sensitivity equations to give the optimizer the exact gradient of the loss.
+        screening_precision: None, or 'float32' to fit and score all the candidates in float32 first. only the best
+                             refit_fraction of them are re-fitted in float64.
+        memo_capacity: the number of templates kept in the memo of fitted expressions across epochs. 0 to disable.
+                       a repeated template reuses the stored fit if it was fitted on the same initial conditions,
+                       otherwise it is re-fitted from the stored constants with memo_refine_iters iterations.
+        memo_eviction: 'lru', 'fifo' or 'worst'. See `FittedExpressionMemo`.
+        linear_fit_iters: None, or fit the candidates that are linear in their constants by least squares, followed by
+                          this many iterations of the optimizer. See `minimize_coefficients.optimize`.
+        derivative_prefit: start fitting the other candidates from the constants that match the smoothed time
+                           derivatives of the trajectories. See `minimize_coefficients.derivative_matching_constants`.
+        n_starts: the number of random starts of the optimizer, evaluated together. See
+                  `minimize_coefficients.multi_start_minimize`.
+        schedule: how `fitting_new_expressions_in_parallel` shares the candidates among the cores.
+                  'dynamic': the free workers take schedule_chunk_size candidates at a time, the most expensive first
+                  (see `estimate_fit_cost`). 'static': one slice of the candidates per core.
+        time_budget, eval_budget: None, or the seconds and the number of objective evaluations the fit of one candidate
+                                  may take. a candidate over the budget keeps the best constants evaluated so far. in
+                                  parallel, a worker stuck in one evaluation is killed after `task_time_limit`, and its
+                                  candidates get the reward -inf. See `minimize_coefficients.FitBudget`.
+        halving_rounds, halving_eta: fit the candidates by successive halving, where only the best 1 / halving_eta of
+                                     the candidates are promoted to a larger budget, halving_rounds times. 0 to fit
+                                     all of them fully. with screening_precision, the lower rungs are fitted in that
+                                     precision instead of refit_fraction. See `successive_halving`.
         """
         self.non_terminal_nodes = non_terminal_nodes
         self.optimizer = optimizer
@@ -62,97 +122,509 @@ class grammarProgram(object):
         self.metric_name = metric_name
         self.n_cores = n_cores
         self.loss_func = all_metrics[metric_name]
+        self.loss_grad_func = all_metrics_grad[metric_name] if use_sensitivity else None
+        assert (integrator_backend, integrator_method) in [('numpy', 'rk4'), ('numpy', 'rk45'),
+                                                           ('numba', 'rk4'), ('numba', 'euler'),
+                                                           ('torch', 'rk4')], \
+            "integrator_method {} is not supported by the {} backend".format(integrator_method, integrator_backend)
+        assert integrator_backend != 'torch' or optimizer in ['Adam', 'LBFGS'], \
+            "optimizer {} is not supported by the torch backend".format(optimizer)
+        self.integrator_kwargs = {'integrator_backend': integrator_backend,
+                                  'integrator_method': integrator_method,
+                                  'divergence_threshold': divergence_threshold,
+                                  'precision': 'float64'}
+        assert screening_precision in [None, 'float32'], "screening_precision should be None or float32"
+        assert screening_precision is None or integrator_method in ['rk4', 'euler'] and integrator_backend != 'torch', \
+            "float32 screening needs a fixed-step numpy or numba integrator"
+        self.screening_kwargs = None
+        if screening_precision is not None:
+            self.screening_kwargs = dict(self.integrator_kwargs, precision=screening_precision)
+        self.refit_fraction = refit_fraction
+        self.fitted_memo = None
+        if memo_capacity > 0:
+            self.fitted_memo = FittedExpressionMemo(memo_capacity, memo_eviction)
+        self.memo_refine_iters = memo_refine_iters
+        self.linear_fit_iters = linear_fit_iters
+        self.derivative_prefit = derivative_prefit
+        self.n_starts = n_starts
+        if schedule not in ['dynamic', 'static']:
+            raise NotImplementedError(schedule, "is not implemented....")
+        self.schedule = schedule
+        self.schedule_chunk_size = schedule_chunk_size
+        self.time_budget = time_budget
+        self.eval_budget = eval_budget
+        assert halving_eta > 1, "halving_eta should be larger than 1"
+        self.halving_rounds = halving_rounds
+        self.halving_eta = halving_eta
         if self.n_cores > 1:
             self.pool = ProcessPool(nodes=self.n_cores)
+            # the last state of the cache of compiled expressions of every worker, which lives as long as the pool.
+            self.worker_caches = {}
 
     def fitting_new_expressions(self, many_seqs_of_rules,
                                 init_cond: np.ndarray, time_span, t_eval,
                                 true_trajectories,
-                                input_var_Xs):
+                                input_var_Xs, integrator_kwargs=None, max_opt_iter=None, warm_constants=None):
         """
         fit the coefficients in the candidate ODEs.
         init_cond: [batch_size, nvars].
         true_trajectories: [batch_size, time_steps, nvars]. the correct trajectories.
+        integrator_kwargs: None to use the setting of the program (and successive halving or screening, if enabled).
+        max_opt_iter: None to use the setting of the program, or the number of iterations of every fit, warm or not.
+        warm_constants: None, or the constants to start fitting every candidate from (None for a random start).
         """
-        result = []
+        if integrator_kwargs is None and self.halving_rounds > 0:
+            return self.successive_halving(self.fitting_new_expressions, many_seqs_of_rules,
+                                           init_cond, time_span, t_eval, true_trajectories, input_var_Xs)
+        if integrator_kwargs is None and self.screening_kwargs is not None:
+            return self.screen_and_refit(self.fitting_new_expressions, many_seqs_of_rules,
+                                         init_cond, time_span, t_eval, true_trajectories, input_var_Xs)
+        integrator_kwargs = integrator_kwargs or self.integrator_kwargs
         print("many_seqs_of_rules:", len(many_seqs_of_rules))
+        all_candiate_odes = [SymbolicDifferentialEquations(one_rules) for one_rules in many_seqs_of_rules]
+        data_key = data_fingerprint(init_cond, t_eval)
+        to_fit = self.lookup_fitted_memo(all_candiate_odes, data_key, integrator_kwargs['precision'])
+        self.set_warm_constants(all_candiate_odes, to_fit, warm_constants)
+        max_opt_iter, warm_start_iters = self.fit_iters(max_opt_iter)
+        if fits_together(self.optimizer, integrator_kwargs):
+            fit_one_expr([all_candiate_odes[i] for i in to_fit],
+                         init_cond, time_span, t_eval, true_trajectories, input_var_Xs, self.loss_func,
+                         self.max_open_constants, max_opt_iter, self.optimizer, self.non_terminal_nodes,
+                         integrator_kwargs)
+            self.store_fitted_memo(all_candiate_odes, to_fit, data_key, integrator_kwargs['precision'])
+            return all_candiate_odes
 
-        for i, one_list_rules in enumerate(many_seqs_of_rules):
-            one_expr = SymbolicDifferentialEquations(one_list_rules)
-            train_loss, fitted_eq, _, _ = optimize(
+        for i, idx in enumerate(to_fit):
+            one_expr = all_candiate_odes[idx]
+            fit_info = {}
+            train_loss, fitted_eq, fitted_constants, _ = optimize(
                 one_expr.expr_template,
                 init_cond, time_span, t_eval,
                 true_trajectories,
                 input_var_Xs,
                 self.loss_func,
                 self.max_open_constants,
-                self.max_opt_iter,
+                max_opt_iter,
                 self.optimizer,
-                self.non_terminal_nodes
+                self.non_terminal_nodes,
+                user_scpeficied_iters=-1 if one_expr.warm_constants is None else warm_start_iters,
+                loss_grad_func=self.loss_grad_func,
+                init_constants=one_expr.warm_constants,
+                linear_refine_iters=self.linear_fit_iters,
+                derivative_prefit=self.derivative_prefit,
+                n_starts=self.n_starts,
+                time_budget=self.time_budget,
+                eval_budget=self.eval_budget,
+                fit_info=fit_info,
+                **integrator_kwargs
             )
 
             one_expr.train_loss = train_loss
             one_expr.fitted_eq = fitted_eq
-            result.append(one_expr)
-            print('idx=', i, f"/ {len(many_seqs_of_rules)}")
+            one_expr.fitted_constants = fitted_constants
+            one_expr.loss_precision = integrator_kwargs['precision']
+            one_expr.prefit_status = fit_info.get('prefit')
+            one_expr.stop_reason = fit_info.get('stop_reason')
+            print('idx=', i, f"/ {len(to_fit)}")
 
             sys.stdout.flush()
-        return result
+        self.store_fitted_memo(all_candiate_odes, to_fit, data_key, integrator_kwargs['precision'])
+        return all_candiate_odes
 
     def fitting_new_expressions_in_parallel(self, many_seqs_of_rules, init_cond: np.ndarray, time_span, t_eval,
                                             true_trajectories,
-                                            input_var_Xs):
+                                            input_var_Xs, integrator_kwargs=None, max_opt_iter=None,
+                                            warm_constants=None):
         """
-        fit the coefficients in many ODE in parallel
+        fit the coefficients in many ODE in parallel. the fitted ODEs are returned in the order of many_seqs_of_rules.
+        integrator_kwargs, max_opt_iter, warm_constants: see `fitting_new_expressions`.
         """
+        if integrator_kwargs is None and self.halving_rounds > 0:
+            return self.successive_halving(self.fitting_new_expressions_in_parallel, many_seqs_of_rules,
+                                           init_cond, time_span, t_eval, true_trajectories, input_var_Xs)
+        if integrator_kwargs is None and self.screening_kwargs is not None:
+            return self.screen_and_refit(self.fitting_new_expressions_in_parallel, many_seqs_of_rules,
+                                         init_cond, time_span, t_eval, true_trajectories, input_var_Xs)
+        integrator_kwargs = integrator_kwargs or self.integrator_kwargs
 
         all_candiate_odes = [SymbolicDifferentialEquations(one_rules) for one_rules in many_seqs_of_rules]
-        many_expr_templates = [all_candiate_odes[i::self.n_cores] for i in range(self.n_cores)]
-
-        init_cond_ncores = [init_cond for _ in range(self.n_cores)]
-        true_trajectories_ncores = [true_trajectories for _ in range(self.n_cores)]
-        input_var_Xes = [input_var_Xs for _ in range(self.n_cores)]
-        time_span_ncores = [time_span for _ in range(self.n_cores)]
-        t_eval_ncores = [t_eval for _ in range(self.n_cores)]
-        evaluate_losses = [self.loss_func for _ in range(self.n_cores)]
-        max_open_constantes = [self.max_open_constants for _ in range(self.n_cores)]
-        max_opt_iteres = [self.max_opt_iter for _ in range(self.n_cores)]
-        optimizeres = [self.optimizer for _ in range(self.n_cores)]
-        non_terminal_nodes = [self.non_terminal_nodes for _ in range(self.n_cores)]
+        data_key = data_fingerprint(init_cond, t_eval)
+        to_fit = self.lookup_fitted_memo(all_candiate_odes, data_key, integrator_kwargs['precision'])
+        self.set_warm_constants(all_candiate_odes, to_fit, warm_constants)
+        if self.schedule == 'dynamic' and not fits_together(self.optimizer, integrator_kwargs):
+            # the most expensive candidates first, handed out schedule_chunk_size at a time to the free workers, so a
+            # slow candidate does not hold back a whole slice.
+            by_cost = sorted(to_fit, key=lambda idx: estimate_fit_cost(all_candiate_odes[idx].expr_template),
+                             reverse=True)
+            many_indices = [by_cost[i:i + self.schedule_chunk_size]
+                            for i in range(0, len(by_cost), self.schedule_chunk_size)]
+        else:
+            # one slice per core (see `fits_together`: a slice is fitted together).
+            many_indices = [to_fit[i::self.n_cores] for i in range(self.n_cores)]
+        many_expr_templates = [[all_candiate_odes[idx] for idx in indices] for indices in many_indices]
+        num_tasks = len(many_expr_templates)
+
         print("NCORES:", self.n_cores)
         print("many_expr_templates {}".format(len(many_expr_templates)))
-        # for i, ti in enumerate(many_expr_templates):
-        #     print(" {}-th: {}".format(i, len(ti)))
-        print(" init_cond_ncores {}, time_span_ncores {}, t_eval_ncores {}, true_trajectories_ncores {}".format(
-            len(init_cond_ncores), len(time_span_ncores), len(t_eval_ncores), len(true_trajectories_ncores)))
-
-        result = self.pool.map(fit_one_expr, many_expr_templates,
-                               init_cond_ncores, time_span_ncores, t_eval_ncores,
-                               true_trajectories_ncores,
-                               input_var_Xes, evaluate_losses,
-                               max_open_constantes, max_opt_iteres, optimizeres, non_terminal_nodes)
-        result = list(chain.from_iterable(result))
+        # the data of this call goes to the workers once, through shared memory; the tasks only carry the candidates.
+        # the workers write the time they start every task into task_start, see `run_tasks`.
+        oracle = SharedOracle({'init_cond': np.asarray(init_cond), 't_eval': np.asarray(t_eval),
+                               'true_trajectories': np.asarray(true_trajectories),
+                               'task_start': np.full(num_tasks, np.nan)},
+                              {'time_span': time_span, 'input_var_Xs': input_var_Xs,
+                               'fit_kwargs': self.worker_fit_kwargs(integrator_kwargs, max_opt_iter)},
+                              writable=('task_start',))
+        start_time = time.time()
+        busy_seconds = 0.0
+        try:
+            # the tasks come back in the order they finish; put the candidates back in order.
+            for task_id, task_result in self.run_tasks(oracle, many_indices, many_expr_templates):
+                if task_result is None:
+                    for idx in many_indices[task_id]:
+                        one_expr = all_candiate_odes[idx]
+                        one_expr.train_loss, one_expr.fitted_eq = -np.inf, one_expr.expr_template
+                        one_expr.loss_precision = integrator_kwargs['precision']
+                        one_expr.stop_reason = 'killed'
+                    continue
+                one_task_result, seconds, (pid, cache_info) = task_result
+                for idx, one_expr in zip(many_indices[task_id], one_task_result):
+                    all_candiate_odes[idx] = one_expr
+                busy_seconds += seconds
+                self.worker_caches[pid] = cache_info
+        finally:
+            oracle.close()
+        wall_seconds = time.time() - start_time
+        if to_fit:
+            print("scheduler: {} tasks of {} candidates in {:.2f}s on {} cores, core utilization {:.3f} "
+                  "(ideal {:.2f}s)".format(num_tasks, len(to_fit), wall_seconds, self.n_cores,
+                                           busy_seconds / (self.n_cores * wall_seconds), busy_seconds / self.n_cores))
+            print("compiled expressions of {} workers: {} cached, {} hits, {} misses so far".format(
+                len(self.worker_caches), sum(info['currsize'] for info in self.worker_caches.values()),
+                sum(info['hits'] for info in self.worker_caches.values()),
+                sum(info['misses'] for info in self.worker_caches.values())))
+        self.store_fitted_memo(all_candiate_odes, to_fit, data_key, integrator_kwargs['precision'])
         print("Done with optimization!")
         sys.stdout.flush()
 
-        return result
+        return all_candiate_odes
+
+    def task_time_limit(self, num_candidates) -> float:
+        # a task (of num_candidates candidates) running longer than this is stuck, see `run_tasks`.
+        return num_candidates * self.time_budget * WORKER_KILL_FACTOR + WORKER_KILL_GRACE
+
+    def run_tasks(self, oracle, many_indices, many_expr_templates):
+        """
+        run the fitting tasks on the pool, and yield (task_id, (fitted candidates, seconds, worker cache)) as they
+        finish. with a time_budget, a task running over its `task_time_limit` means its worker is stuck in one
+        evaluation: the pool is recycled, the overdue tasks are yielded as (task_id, None), and the other unfinished
+        tasks are submitted again to the new workers.
+        """
+        task_start = oracle.arrays['task_start']
+        pending = set(range(len(many_indices)))
+        while pending:
+            task_ids = sorted(pending)
+            task_start[task_ids] = np.nan
+            results = self.pool.uimap(fit_shared_oracle, [oracle.handle] * len(task_ids), task_ids,
+                                      [many_expr_templates[k] for k in task_ids])
+            recycled = False
+            while pending and not recycled:
+                try:
+                    timeout = None if self.time_budget is None else WATCHDOG_INTERVAL
+                    task_id, *task_result = results.next(timeout=timeout)
+                except PoolTimeoutError:
+                    now = time.time()
+                    overdue = [k for k in pending if now - task_start[k] > self.task_time_limit(len(many_indices[k]))]
+                    if overdue:
+                        print("kill the workers stuck in the tasks {} over {:.1f}s".format(
+                            overdue, max(now - task_start[k] for k in overdue)))
+                        self.recycle_pool()
+                        recycled = True
+                    for k in overdue:
+                        pending.discard(k)
+                        yield k, None
+                    continue
+                pending.discard(task_id)
+                yield task_id, task_result
+
+    def recycle_pool(self):
+        # terminate all the workers, the stuck ones included; the next map starts new workers with empty caches.
+        self.pool.terminate()
+        self.pool.clear()
+        self.worker_caches = {}
+
+    def report_budgets(self, all_candiate_odes):
+        """print how many fits were stopped by the budgets, or killed, for each reason."""
+        reasons = [one_expr.stop_reason for one_expr in all_candiate_odes if one_expr.stop_reason is not None]
+        if reasons:
+            print("fits over the budget: {} time_budget, {} eval_budget, {} killed of {} candidates".format(
+                reasons.count('time_budget'), reasons.count('eval_budget'), reasons.count('killed'),
+                len(all_candiate_odes)))
+
+    def worker_fit_kwargs(self, integrator_kwargs, max_opt_iter=None) -> dict:
+        # the arguments of `fit_one_expr` from the settings of the program, without the functions, see `fit_shared_oracle`.
+        max_opt_iter, warm_start_iters = self.fit_iters(max_opt_iter)
+        return {'metric_name': self.metric_name, 'use_sensitivity': self.loss_grad_func is not None,
+                'max_open_constants': self.max_open_constants, 'max_opt_iter': max_opt_iter,
+                'optimizer_name': self.optimizer, 'non_terminal_nodes': self.non_terminal_nodes,
+                'integrator_kwargs': integrator_kwargs, 'warm_start_iters': warm_start_iters,
+                'linear_refine_iters': self.linear_fit_iters, 'derivative_prefit': self.derivative_prefit,
+                'n_starts': self.n_starts, 'time_budget': self.time_budget, 'eval_budget': self.eval_budget}
+
+    def fit_iters(self, max_opt_iter=None):
+        # the iterations of the fits from random starts and from warm constants.
+        if max_opt_iter is None:
+            return self.max_opt_iter, self.memo_refine_iters
+        return max_opt_iter, max_opt_iter
+
+    def set_warm_constants(self, all_candiate_odes, to_fit, warm_constants):
+        # the given constants take over the warm start from the memo.
+        if warm_constants is None:
+            return
+        for idx in to_fit:
+            if warm_constants[idx] is not None:
+                all_candiate_odes[idx].warm_constants = warm_constants[idx]
+
+    def memo_key(self, one_expr, precision):
+        # the normalized template: the constants are numbered in the same order whenever the key is the same.
+        return tuple(simplify_template(one_expr.expr_template)), precision
+
+    def lookup_fitted_memo(self, all_candiate_odes, data_key, precision):
+        """
+        take the fit of the candidates fitted on the same data from the memo, and set the warm start of the candidates
+        fitted on other data. return the indices of the candidates left to fit.
+        """
+        if self.fitted_memo is None:
+            return list(range(len(all_candiate_odes)))
+        to_fit = []
+        for i, one_expr in enumerate(all_candiate_odes):
+            key = self.memo_key(one_expr, precision)
+            # counted once per template and epoch, whatever the rung of successive halving or the precision.
+            status, entry = self.fitted_memo.lookup(key, data_key, candidate=key[0])
+            if status == 'exact':
+                one_expr.train_loss = entry['train_loss']
+                one_expr.fitted_eq = entry['fitted_eq']
+                one_expr.fitted_constants = entry['constants']
+                one_expr.loss_precision = precision
+                continue
+            elif status == 'warm':
+                one_expr.warm_constants = entry['constants']
+            to_fit.append(i)
+        return to_fit
+
+    def store_fitted_memo(self, all_candiate_odes, to_fit, data_key, precision):
+        if self.fitted_memo is None:
+            return
+        for i in to_fit:
+            one_expr = all_candiate_odes[i]
+            if one_expr.train_loss is not None:
+                self.fitted_memo.store(self.memo_key(one_expr, precision), data_key, one_expr.fitted_constants,
+                                       one_expr.train_loss, one_expr.fitted_eq)
+
+    def report_prefit(self, all_candiate_odes):
+        """print how often the derivative pre-fit was already as good as the full fit."""
+        statuses = [one_expr.prefit_status for one_expr in all_candiate_odes if one_expr.prefit_status is not None]
+        if not statuses:
+            return
+        print("derivative pre-fit: {} sufficient, {} refined, {} failed of {} candidates (sufficient rate {:.3f})".format(
+            statuses.count('sufficient'), statuses.count('refined'), statuses.count('failed'), len(statuses),
+            statuses.count('sufficient') / len(statuses)))
+
+    def screen_and_refit(self, fitting_method, many_seqs_of_rules, *args):
+        """
+        fit and score all the candidates in the screening precision, then re-fit the best refit_fraction of them in
+        float64, so the candidates that can reach the top-K carry a float64 loss.
+        fitting_method: `fitting_new_expressions` or `fitting_new_expressions_in_parallel`.
+        """
+        screened = fitting_method(many_seqs_of_rules, *args, integrator_kwargs=self.screening_kwargs)
+        finite_idx = [i for i, one_expr in enumerate(screened) if np.isfinite(one_expr.train_loss)]
+        num_refit = int(np.ceil(self.refit_fraction * len(finite_idx)))
+        refit_idx = sorted(finite_idx, key=lambda i: screened[i].train_loss, reverse=True)[:num_refit]
+        print("re-fit the best {} of {} screened candidates in float64".format(len(refit_idx), len(screened)))
+        if refit_idx:
+            refitted = fitting_method([screened[i].traversal for i in refit_idx], *args,
+                                      integrator_kwargs=self.integrator_kwargs)
+            for i, one_expr in zip(refit_idx, refitted):
+                screened[i] = one_expr
+        return screened
+
+    def successive_halving(self, fitting_method, many_seqs_of_rules, init_cond, time_span, t_eval, true_trajectories,
+                           input_var_Xs):
+        """
+        fit the candidates by successive halving: over halving_rounds + 1 rungs, rung r fits the candidates left with
+        max_opt_iter * halving_eta ** (r - halving_rounds) iterations on the same fraction of the initial conditions,
+        starting from the constants of the rung before, and promotes the best 1 / halving_eta of them. the last rung is
+        the usual fit on all the data.
+        the candidates dropped on the way are scored on all the data with their last constants (see `rescore_dropped`),
+        so every reward is the loss of real constants on the same data, at most the reward of the full fit.
+        fitting_method: `fitting_new_expressions` or `fitting_new_expressions_in_parallel`.
+        """
+        init_cond, true_trajectories = np.asarray(init_cond), np.asarray(true_trajectories)
+        all_candiate_odes = [None] * len(many_seqs_of_rules)
+        warm_constants = [None] * len(many_seqs_of_rules)
+        alive = list(range(len(many_seqs_of_rules)))
+        dropped = []
+        for rung in range(self.halving_rounds + 1):
+            fraction = float(self.halving_eta) ** (rung - self.halving_rounds)
+            num_init = max(1, int(np.ceil(fraction * len(init_cond))))
+            num_iters = max(1, int(np.ceil(fraction * self.max_opt_iter)))
+            last_rung = rung == self.halving_rounds
+            # the lower rungs only rank the candidates, in the screening precision if enabled.
+            integrator_kwargs = self.integrator_kwargs
+            if not last_rung and self.screening_kwargs is not None:
+                integrator_kwargs = self.screening_kwargs
+            print("successive halving rung {}: {} candidates, {} iterations on {} of {} initial conditions".format(
+                rung, len(alive), num_iters, num_init, len(init_cond)))
+            fitted = fitting_method([many_seqs_of_rules[i] for i in alive], init_cond[:num_init], time_span, t_eval,
+                                    true_trajectories[:num_init], input_var_Xs, integrator_kwargs=integrator_kwargs,
+                                    max_opt_iter=num_iters, warm_constants=[warm_constants[i] for i in alive])
+            for i, one_expr in zip(alive, fitted):
+                all_candiate_odes[i] = one_expr
+            if last_rung:
+                break
+            finite_idx = [i for i in alive if np.isfinite(all_candiate_odes[i].train_loss)]
+            ranked = sorted(finite_idx, key=lambda i: all_candiate_odes[i].train_loss, reverse=True)
+            promoted = ranked[:int(np.ceil(len(alive) / self.halving_eta))]
+            dropped.extend(i for i in alive if i not in promoted)
+            for i in promoted:
+                constants = all_candiate_odes[i].fitted_constants
+                warm_constants[i] = constants if np.ndim(constants) == 1 else None
+            alive = promoted
+        self.rescore_dropped([all_candiate_odes[i] for i in dropped], init_cond, time_span, t_eval, true_trajectories,
+                             input_var_Xs)
+        return all_candiate_odes
+
+    def rescore_dropped(self, dropped_odes, init_cond, time_span, t_eval, true_trajectories, input_var_Xs):
+        """the loss of the fitted equations of the candidates dropped by `successive_halving` on all the data."""
+        var_ytrue = np.var(true_trajectories)
+        for one_expr in dropped_odes:
+            if not np.isfinite(one_expr.train_loss):
+                continue
+            pred_trajectories = execute(one_expr.fitted_eq, init_cond, time_span, t_eval, input_var_Xs,
+                                        **self.integrator_kwargs)
+            one_expr.train_loss = self.loss_func(pred_trajectories, true_trajectories, var_ytrue)
+            one_expr.loss_precision = self.integrator_kwargs['precision']
+
+
+def estimate_fit_cost(expr_template: list) -> float:
+    """
+    the expected cost of fitting a candidate, only to rank the candidates. every iteration of the optimizer takes
+    (num_constants + 1) simulations for the finite differences, the number of iterations grows with the number of
+    constants, and one simulation costs about the depth of the expressions.
+    """
+    template = simplify_template(expr_template)
+    num_constants = sum(len(OPEN_CONSTANT.findall(eq)) for eq in template)
+    return (num_constants + 1) ** 2 * sum(_template_depth(eq) for eq in template)
+
+
+def _template_depth(eq: str) -> int:
+    try:
+        node = ast.parse(eq, mode='eval').body
+    except SyntaxError:
+        return 1
+
+    def depth(one_node):
+        return 1 + max((depth(child) for child in ast.iter_child_nodes(one_node)), default=0)
+
+    return depth(node)
+
+
+def fits_together(optimizer_name, integrator_kwargs) -> bool:
+    """
+    whether `fit_one_expr` fits a batch of candidates together: with the torch backend (see `optimize_many`), or with
+    differential evolution and the numpy rk4 integrator (see `optimize_population`).
+    """
+    integrator_kwargs = integrator_kwargs or {}
+    if integrator_kwargs.get('integrator_backend') == 'torch':
+        return True
+    return optimizer_name == 'differential_evolution' and integrator_kwargs.get('integrator_backend') == 'numpy' \
+        and integrator_kwargs.get('integrator_method') == 'rk4'
+
+
+def fit_shared_oracle(handle, task_id, one_expr_batch):
+    """
+    the task of a worker of the pool: `fit_one_expr` on the data and the settings shared through handle
+    (see `SharedOracle`). return the task_id, the fitted candidates, the seconds it took, and the pid of the worker with
+    the state of its cache of compiled expressions, which lives as long as the worker.
+    """
+    oracle = attach_oracle(handle)
+    oracle['task_start'][task_id] = time.time()
+    fit_kwargs = dict(oracle['fit_kwargs'])
+    metric_name, use_sensitivity = fit_kwargs.pop('metric_name'), fit_kwargs.pop('use_sensitivity')
+    start_time = time.time()
+    results = fit_one_expr(one_expr_batch, oracle['init_cond'], oracle['time_span'], oracle['t_eval'],
+                           oracle['true_trajectories'], oracle['input_var_Xs'], all_metrics[metric_name],
+                           loss_grad_func=all_metrics_grad[metric_name] if use_sensitivity else None, **fit_kwargs)
+    return task_id, results, time.time() - start_time, (os.getpid(), compiled_expressions.cache_info())
 
 
 def fit_one_expr(one_expr_batch, init_cond, time_span, t_eval, true_trajectories, input_var_Xs, loss_func,
                  max_open_constants, max_opt_iter,
-                 optimizer_name, non_terminal_nodes):
+                 optimizer_name, non_terminal_nodes, integrator_kwargs=None, loss_grad_func=None,
+                 warm_start_iters=-1, linear_refine_iters=None, derivative_prefit=False,
+                 n_starts=1, time_budget=None, eval_budget=None):
+    """
+    fit a batch of candidates one after another (all together, see `fits_together`).
+    warm_start_iters: the number of optimization iterations of the candidates with warm_constants.
+    linear_refine_iters, derivative_prefit, n_starts, time_budget, eval_budget: see `minimize_coefficients.optimize`.
+    """
     results = []
+    if not one_expr_batch:
+        return results
+    if fits_together(optimizer_name, integrator_kwargs):
+        # fit the whole batch together.
+        if integrator_kwargs['integrator_backend'] == 'torch':
+            many_results = optimize_many(
+                [one_expr.expr_template for one_expr in one_expr_batch],
+                init_cond, time_span, t_eval,
+                true_trajectories,
+                input_var_Xs,
+                loss_func, max_open_constants, max_opt_iter, optimizer_name,
+                non_terminal_nodes,
+                **integrator_kwargs)
+        else:
+            # the warm candidates start from their constants, with the same number of generations as the others.
+            many_results = optimize_population(
+                [one_expr.expr_template for one_expr in one_expr_batch],
+                init_cond, time_span, t_eval,
+                true_trajectories,
+                input_var_Xs,
+                loss_func, max_open_constants, max_opt_iter, optimizer_name,
+                non_terminal_nodes,
+                init_constants=[one_expr.warm_constants for one_expr in one_expr_batch],
+                **integrator_kwargs)
+        for one_expr, (train_loss, fitted_eq, fitted_constants, _) in zip(one_expr_batch, many_results):
+            one_expr.train_loss = train_loss
+            one_expr.fitted_eq = fitted_eq
+            one_expr.fitted_constants = fitted_constants
+            one_expr.loss_precision = integrator_kwargs['precision']
+            results.append(one_expr)
+        return results
     for one_expr in one_expr_batch:
-        train_loss, fitted_eq, _, _ = optimize(
+        fit_info = {}
+        train_loss, fitted_eq, fitted_constants, _ = optimize(
             one_expr.expr_template,
             init_cond, time_span, t_eval,
             true_trajectories,
             input_var_Xs,
             loss_func, max_open_constants, max_opt_iter, optimizer_name,
-            non_terminal_nodes)
+            non_terminal_nodes,
+            user_scpeficied_iters=-1 if one_expr.warm_constants is None else warm_start_iters,
+            loss_grad_func=loss_grad_func,
+            init_constants=one_expr.warm_constants,
+            linear_refine_iters=linear_refine_iters,
+            derivative_prefit=derivative_prefit,
+            n_starts=n_starts,
+            time_budget=time_budget,
+            eval_budget=eval_budget,
+            fit_info=fit_info,
+            **(integrator_kwargs or {}))
 
         one_expr.train_loss = train_loss
         one_expr.fitted_eq = fitted_eq
+        one_expr.fitted_constants = fitted_constants
+        one_expr.loss_precision = (integrator_kwargs or {}).get('precision', 'float64')
+        one_expr.prefit_status = fit_info.get('prefit')
+        one_expr.stop_reason = fit_info.get('stop_reason')
         results.append(one_expr)
 
     return results
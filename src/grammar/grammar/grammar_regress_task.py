@@ -51,6 +51,11 @@ class RegressTask(object):
         self.init_cond = init_cond.reshape([-1, self.n_vars])
         return self.init_cond
 
+    def reset_trajectory_cache(self):
+        """start a new epoch: the true trajectories cached by the oracle are not reused anymore."""
+        if hasattr(self.data_query_oracle, 'reset_trajectory_cache'):
+            self.data_query_oracle.reset_trajectory_cache()
+
     def evaluate(self):
         return self.data_query_oracle.evaluate(self.init_cond, self.time_span, self.t_evals)
 
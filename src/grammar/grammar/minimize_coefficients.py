@@ -1,5 +1,6 @@
 """optimize the coefficients in the candidate ODEs"""
 import sys
+import time
 
 import numpy as np
 import warnings
@@ -11,11 +12,21 @@ from grammar.utils import pretty_print_expr
 from grammar.production_rules import check_non_terminal_nodes
 
 from sympy.parsing.sympy_parser import parse_expr
-from sympy import lambdify, symbols, Symbol
+from sympy import lambdify, symbols, Symbol, diff, sympify
 from scipy.optimize import minimize
 from scipy.optimize import basinhopping, shgo, dual_annealing, direct
+from scipy.signal import savgol_filter
 
-from grammar.odeint.numpy_odeint import runge_kutta4
+from numba.core.errors import NumbaError
+from sympy.printing.codeprinter import PrintMethodNotImplementedError
+
+from grammar.odeint.numpy_odeint import batched_rhs, batch_runge_kutta4, batch_dormand_prince, has_diverged
+from grammar.odeint.numba_odeint import compile_ode_kernel
+from grammar.expression_cache import compiled_expressions, canonical_skeleton, rhs_source, rhs_from_source
+from grammar.expression_template import simplify_template, number_constants, substitute_constants
+from grammar.expression_tree import tree_from_str, tree_source, compile_source, compile_trees, offset_variables
+from grammar.expression_tree import offset_constants
+from grammar.expression_tree import linear_in_constants, evaluate_tree
 
 
 def optimize(candidate_ode_equations: list, init_cond, time_span, t_eval, true_trajectories, input_var_Xs,
@@ -23,6 +34,18 @@ def optimize(candidate_ode_equations: list, init_cond, time_span, t_eval, true_t
              optimizer_name,
              non_terminal_nodes,
              user_scpeficied_iters=-1,
+             integrator_backend='numpy',
+             integrator_method='rk4',
+             divergence_threshold=None,
+             loss_grad_func=None,
+             precision='float64',
+             init_constants=None,
+             linear_refine_iters=None,
+             derivative_prefit=False,
+             n_starts=1,
+             time_budget=None,
+             eval_budget=None,
+             fit_info=None,
              verbose=False):
     """
     optimize the constant coefficients in the candidate expressions.
@@ -43,8 +66,40 @@ def optimize(candidate_ode_equations: list, init_cond, time_span, t_eval, true_t
 
     optimizer_name: name of the optimizer. See scipy.optimize.minimize for list of optimizers
     non_terminal_nodes: list of non-terminal nodes. It is used for checking if the expression is valid
-
+    integrator_backend, integrator_method, divergence_threshold: how the candidates are simulated.
+                        See `compile_simulator`.
+    loss_grad_func: the gradient of loss_func w.r.t. the predicted trajectories. If given, the sensitivity equations are
+                    integrated next to the state, so the optimizer gets the exact gradient of the loss in the same pass
+                    instead of finite differences. See `compile_sensitivity_simulator`.
+    precision: "float64", or "float32" to screen the candidates cheaply. the trajectories and the loss are computed in
+               this precision. See `compile_simulator`.
+    init_constants: start the optimizer from these constants (e.g., fitted in an earlier epoch) instead of random ones.
+    linear_refine_iters: None, or fit the constants of the candidates that are linear in their constants in one least
+                         squares solve (see `linear_least_squares_constants`), then refine them with this many
+                         iterations of the optimizer (0 to keep the least squares solution).
+    derivative_prefit: start the optimizer of the other candidates from the constants that match the candidate ODEs to
+                       the smoothed time derivatives of true_trajectories (see `derivative_matching_constants`),
+                       instead of random ones.
+    n_starts: the number of random starts of the optimizer, if it does not start from given (or pre-fitted) constants.
+              all the starts are evaluated in one batch, and only the best ones are optimized, see
+              `multi_start_minimize`.
+    time_budget, eval_budget: None, or the seconds (from the call) and the number of evaluations of the objective
+                              the fit may take. once either is spent, the optimizer is stopped and the candidate keeps
+                              the best constants evaluated so far (see `FitBudget`).
+    fit_info: None, or a dict where fit_info["stop_reason"] is set to "time_budget" or "eval_budget" if the fit was
+              stopped by that budget, and fit_info["prefit"] is set to "sufficient" if the pre-fitted constants were
+              already as good as the optimized ones (see `PREFIT_RTOL`), "refined" if the optimizer improved them, or
+              "failed" if they could not be pre-fitted.
     """
+    integrator_kwargs = {'integrator_backend': integrator_backend,
+                         'integrator_method': integrator_method,
+                         'divergence_threshold': divergence_threshold,
+                         'precision': precision}
+    budget = FitBudget(time_budget, eval_budget)
+    init_cond = np.asarray(init_cond, dtype=precision)
+    true_trajectories = np.asarray(true_trajectories, dtype=precision)
+    # the step of the finite differences has to be above the round-off of the loss.
+    finite_diff_step = None if np.dtype(precision) == np.float64 else np.sqrt(np.finfo(precision).eps)
 
     candidate_ode_equations = simplify_template(candidate_ode_equations)
     print("candidate:", candidate_ode_equations)
@@ -52,76 +107,137 @@ def optimize(candidate_ode_equations: list, init_cond, time_span, t_eval, true_t
         # not a valid equation
         return -np.inf, candidate_ode_equations, 0, np.inf
 
-    # count the total number of constants in equation
-    num_changing_consts = sum([x.count('C') for x in candidate_ode_equations])
+    # number the constants in equation
+    numbered_ode_equations, c_lst = number_constants(candidate_ode_equations)
+    num_changing_consts = len(c_lst)
     t_optimized_constants, t_optimized_obj = 0, np.inf
     if num_changing_consts == 0:
         # zero constant
         var_ytrue = np.var(true_trajectories)
-        pred_trajectories = execute(candidate_ode_equations, init_cond, time_span, t_eval, input_var_Xs)
+        pred_trajectories = execute(candidate_ode_equations, init_cond, time_span, t_eval, input_var_Xs,
+                                    **integrator_kwargs)
     elif num_changing_consts >= max_open_constants:
         # discourage over expressions with too many coefficients.
         return -np.inf, candidate_ode_equations, t_optimized_constants, t_optimized_obj
     else:
-        c_lst = ['c' + str(i) for i in range(num_changing_consts)]
-        c_symbols = [Symbol('c' + str(i)) for i in range(num_changing_consts)]
-        temp_equations = "$$".join(candidate_ode_equations)
-        for c in c_lst:
-            temp_equations = temp_equations.replace('C', c, 1)
-        candidate_ode_equations = temp_equations.split("$$")
+        candidate_ode_equations = numbered_ode_equations
         """
         To improve performance, it's better to pre-compile the symbolic expression outside the optimization loop 
         and use the resulting function directly within the objective function. 
         This way, the symbolic expression is only compiled once.
         """
         try:
-            expr_odes = [parse_expr(one_expr) for one_expr in candidate_ode_equations]
-            t = symbols('t')  # not used in this case
-            num_function = lambdify((t, *input_var_Xs, *c_symbols), expr_odes)
+            simulate = cached_simulator(candidate_ode_equations, input_var_Xs, c_lst,
+                                        sensitivity=loss_grad_func is not None, **integrator_kwargs)
         except Exception as e:
             print(e)
             return -np.inf, candidate_ode_equations, 0, np.inf
         def objective_function(coef):
-            def derivative(t, state):
-                return num_function(t, *state, *coef)
-
-            pred_trajectories = []
-            for one_x_init in init_cond:
-                # one_solution = solve_ivp(derivative, t_span=time_span, t_evals=t_eval, y0=one_x_init, method='RK45')
-                # pred_trajectories.append(one_solution.y)
-                one_solution = runge_kutta4(derivative, t_eval, one_x_init)
-                pred_trajectories.append(one_solution)
-            pred_trajectories = np.asarray(pred_trajectories)
+            pred_trajectories = simulate(t_eval, init_cond, coef)
             var_ytrue = np.var(true_trajectories)
             objective_value = -loss_func(pred_trajectories, true_trajectories, var_ytrue)
             # print(coef, objective_value)
             return objective_value
 
+        def objective_function_and_grad(coef):
+            pred_trajectories, sensitivities = simulate(t_eval, init_cond, coef)
+            var_ytrue = np.var(true_trajectories)
+            objective_value = -loss_func(pred_trajectories, true_trajectories, var_ytrue)
+            if not np.isfinite(objective_value):
+                return objective_value, np.zeros(len(coef))
+            # chain rule: d loss / d c_k = sum_{b,t,i} d loss / d x_{b,t,i} * d x_{b,t,i} / d c_k
+            loss_grad = loss_grad_func(pred_trajectories, true_trajectories, var_ytrue)
+            objective_grad = -np.einsum('bti,btik->k', loss_grad, sensitivities)
+            return objective_value, objective_grad
+
+        objective_function = budget.wrap(objective_function)
+        objective_function_and_grad = budget.wrap(objective_function_and_grad)
+        fun = objective_function if loss_grad_func is None else lambda coef: objective_function_and_grad(coef)[0]
         # do more than one experiment,
         x0 = np.random.rand(len(c_lst))
+        random_start = True
+        skip_optimizer = False
+        evaluate_prefit = False
+        prefit_obj = None
+        linear_constants = None
         try:
+            if init_constants is not None and len(init_constants) == len(c_lst) and np.all(np.isfinite(init_constants)):
+                x0 = np.asarray(init_constants, dtype=float)
+                random_start = False
+            elif linear_refine_iters is not None:
+                linear_constants = linear_least_squares_constants(candidate_ode_equations, c_lst, input_var_Xs, t_eval,
+                                                                  true_trajectories)
+                if linear_constants is not None:
+                    x0 = linear_constants
+                    random_start = False
+                    user_scpeficied_iters = linear_refine_iters
+                    skip_optimizer = linear_refine_iters == 0
+            if derivative_prefit and init_constants is None and linear_constants is None:
+                prefit_constants = derivative_matching_constants(candidate_ode_equations, c_lst, input_var_Xs, t_eval,
+                                                                 true_trajectories, optimizer_name, max_opt_iter)
+                if prefit_constants is not None:
+                    x0 = prefit_constants
+                    random_start = False
+                    evaluate_prefit = True
+                elif fit_info is not None:
+                    fit_info['prefit'] = 'failed'
             if user_scpeficied_iters > 0:
                 max_opt_iter = user_scpeficied_iters
-            opt_result = scipy_minimize(objective_function, x0, optimizer_name, num_changing_consts, max_opt_iter)
+            if loss_grad_func is None:
+                def minimize_from(x):
+                    return scipy_minimize(objective_function, x, optimizer_name, num_changing_consts, max_opt_iter,
+                                          finite_diff_step=finite_diff_step)
+            else:
+                def minimize_from(x):
+                    return scipy_minimize(objective_function_and_grad, x, optimizer_name, num_changing_consts,
+                                          max_opt_iter, jac=True)
+            try:
+                if evaluate_prefit:
+                    prefit_obj = fun(x0)
+                if skip_optimizer:
+                    opt_result = {'x': x0, 'fun': fun(x0)}
+                elif optimizer_name == 'differential_evolution' or n_starts > 1 and random_start:
+                    population_simulate = simulate if loss_grad_func is None else cached_simulator(
+                        candidate_ode_equations, input_var_Xs, c_lst, **integrator_kwargs)
+
+                    def population_objective(population):
+                        var_ytrue = np.var(true_trajectories)
+                        return [-loss_func(pred_trajectories, true_trajectories, var_ytrue)
+                                for pred_trajectories in population_simulate(t_eval, init_cond, population)]
+
+                    population_objective = budget.wrap(population_objective, population=True)
+                    if optimizer_name == 'differential_evolution':
+                        first_generation = evolution_first_generation(num_changing_consts,
+                                                                      [None if random_start else x0])
+                        best_x, best_obj = population_evolution(
+                            lambda members, _: np.asarray(population_objective(members[0]))[None],
+                            first_generation, max_opt_iter)
+                        opt_result = {'x': best_x[0], 'fun': best_obj[0]}
+                    else:
+                        # the usual start, and the others spread over the same box as the global optimizers.
+                        starts = np.vstack([x0, np.random.uniform(-5, 5, (n_starts - 1, num_changing_consts))])
+                        opt_result = multi_start_minimize(population_objective, minimize_from, starts,
+                                                          fd_step=finite_diff_step or 1e-6)
+                else:
+                    opt_result = minimize_from(x0)
+            except FitBudgetExceeded as e:
+                print("stopped by the {}: {} evaluations in {:.2f}s".format(e.reason, budget.num_evals,
+                                                                          budget.elapsed()))
+                if fit_info is not None:
+                    fit_info['stop_reason'] = e.reason
+                if budget.best_x is None:
+                    return -np.inf, candidate_ode_equations, 0, np.inf
+                opt_result = {'x': budget.best_x, 'fun': budget.best_fun}
             t_optimized_constants = opt_result['x']
-            c_lst = t_optimized_constants.tolist()
             t_optimized_obj = opt_result['fun']
+            if prefit_obj is not None and fit_info is not None:
+                fit_info['prefit'] = 'sufficient' if prefit_is_sufficient(prefit_obj, t_optimized_obj) else 'refined'
 
             if verbose:
                 print(opt_result)
-            eq_est = candidate_ode_equations
-
-            for i in range(len(c_lst)):
-                temp = []
-                for one_eq in eq_est:
-                    est_c = np.mean(c_lst[i])
-                    if abs(est_c) < 1e-5:
-                        est_c = 0
-                    one_eq = one_eq.replace('c' + str(i), str(est_c), 1)
-                    temp.append(one_eq)
-                eq_est = temp
-
-            pred_trajectories = execute(eq_est, init_cond, time_span, t_eval, input_var_Xs)
+            eq_est = substitute_constants(candidate_ode_equations, c_lst, t_optimized_constants)
+
+            pred_trajectories = execute(eq_est, init_cond, time_span, t_eval, input_var_Xs, **integrator_kwargs)
             # what is this?
             var_ytrue = np.var(true_trajectories)
 
@@ -140,8 +256,453 @@ def optimize(candidate_ode_equations: list, init_cond, time_span, t_eval, true_t
     return train_loss, candidate_ode_equations, t_optimized_constants, t_optimized_obj
 
 
+def optimize_many(many_candidate_ode_equations: list, init_cond, time_span, t_eval, true_trajectories, input_var_Xs,
+                  loss_func, max_open_constants, max_opt_iter,
+                  optimizer_name,
+                  non_terminal_nodes,
+                  user_scpeficied_iters=-1,
+                  integrator_backend='torch',
+                  integrator_method='rk4',
+                  divergence_threshold=None,
+                  precision='float64',
+                  learning_rate=0.05):
+    """
+    optimize the constant coefficients of many candidates together with torch autograd.
+    the variables and constants of the k-th candidate are renamed to X0_k, X1_k, ... and c0_k, c1_k, ..., so all the
+    candidates share one right-hand side: the state [batch_size, n_candidates * nvars] is integrated in one pass and one
+    optimizer (Adam or LBFGS) fits all the constants at once.
+
+    many_candidate_ode_equations: list of candidates. each candidate is a list of strings, as in `optimize`.
+    the other parameters are the same as `optimize`; the constants are fitted in float64.
+    return: one (train_loss, fitted equations, optimized constants, optimized objective) per candidate, as `optimize`.
+    """
+    from grammar.odeint import torch_odeint
+    integrator_kwargs = {'integrator_backend': integrator_backend,
+                         'integrator_method': integrator_method,
+                         'divergence_threshold': divergence_threshold,
+                         'precision': precision}
+    if user_scpeficied_iters > 0:
+        max_opt_iter = user_scpeficied_iters
+    results = [None] * len(many_candidate_ode_equations)
+    nvars = len(input_var_Xs)
+    stacked_idx, stacked_odes, stacked_Xs, stacked_cs = [], [], [], []
+    for k, candidate_ode_equations in enumerate(many_candidate_ode_equations):
+        candidate_ode_equations = simplify_template(candidate_ode_equations)
+        numbered_ode_equations, c_names = number_constants(candidate_ode_equations, 'c{}_%d' % k)
+        num_changing_consts = len(c_names)
+        if num_changing_consts == 0 or check_non_terminal_nodes(candidate_ode_equations, non_terminal_nodes):
+            # nothing to fit together with the others.
+            results[k] = optimize(candidate_ode_equations, init_cond, time_span, t_eval, true_trajectories,
+                                  input_var_Xs, loss_func, max_open_constants, max_opt_iter, optimizer_name,
+                                  non_terminal_nodes, **integrator_kwargs)
+            continue
+        elif num_changing_consts >= max_open_constants:
+            # discourage over expressions with too many coefficients.
+            results[k] = (-np.inf, candidate_ode_equations, 0, np.inf)
+            continue
+        try:
+            expr_odes = [parse_expr(one_expr) for one_expr in numbered_ode_equations]
+        except Exception as e:
+            print(e)
+            results[k] = (-np.inf, candidate_ode_equations, 0, np.inf)
+            continue
+        renamed_Xs = [Symbol('{}_{}'.format(xi, k)) for xi in input_var_Xs]
+        mapping = dict(zip(input_var_Xs, renamed_Xs))
+        stacked_odes.extend([one_ode.xreplace(mapping) for one_ode in expr_odes])
+        stacked_Xs.extend(renamed_Xs)
+        stacked_cs.append([Symbol(ci) for ci in c_names])
+        stacked_idx.append(k)
+
+    def fit_stack(idx):
+        # fit the candidates listed in idx (positions in stacked_idx) together.
+        odes = [one_ode for j in idx for one_ode in stacked_odes[j * nvars:(j + 1) * nvars]]
+        Xs = [xi for j in idx for xi in stacked_Xs[j * nvars:(j + 1) * nvars]]
+        cs = [ci for j in idx for ci in stacked_cs[j]]
+        owners = [pos for pos, j in enumerate(idx) for _ in stacked_cs[j]]
+        t = symbols('t')  # not used in this case
+        num_function = torch_odeint.lambdify_torch((t, Xs, cs), odes)
+
+        def derivative(t, state, theta):
+            return torch_odeint.batched_rhs(lambda t, state: num_function(t, state, theta))(t, state)
+
+        return torch_odeint.fit_stacked_constants(derivative, np.random.rand(len(cs)), owners, t_eval,
+                                                  np.tile(init_cond, (1, len(idx))), true_trajectories, len(idx),
+                                                  optimizer_name, max_opt_iter, learning_rate)
+
+    all_idx = list(range(len(stacked_idx)))
+    fitted = {}
+    try:
+        theta, _ = fit_stack(all_idx)
+        offsets = np.cumsum([0] + [len(stacked_cs[j]) for j in all_idx])
+        fitted = {j: theta[offsets[j]:offsets[j + 1]] for j in all_idx}
+    except (TypeError, KeyError, ValueError, NameError, RuntimeError) as e:
+        # one bad candidate should not spoil the whole stack; fall back to fit them one by one.
+        for j in all_idx:
+            try:
+                fitted[j], _ = fit_stack([j])
+            except (TypeError, KeyError, ValueError, NameError, RuntimeError) as e:
+                print(e)
+
+    for j, k in enumerate(stacked_idx):
+        candidate_ode_equations = simplify_template(many_candidate_ode_equations[k])
+        if j not in fitted:
+            results[k] = (-np.inf, candidate_ode_equations, 0, np.inf)
+            continue
+        t_optimized_constants = fitted[j]
+        est_cs = {ci: sympify(0 if abs(est_c) < 1e-5 else float(est_c)) for ci, est_c in zip(stacked_cs[j], fitted[j])}
+        inverse_mapping = {Symbol('{}_{}'.format(xi, k)): xi for xi in input_var_Xs}
+        eq_est = [str(one_ode.xreplace(est_cs).xreplace(inverse_mapping))
+                  for one_ode in stacked_odes[j * nvars:(j + 1) * nvars]]
+        pred_trajectories = execute(eq_est, init_cond, time_span, t_eval, input_var_Xs, **integrator_kwargs)
+        var_ytrue = np.var(true_trajectories)
+        train_loss = loss_func(pred_trajectories, true_trajectories, var_ytrue)
+        candidate_ode_equations = [pretty_print_expr(parse_expr(one_expr)) for one_expr in eq_est]
+        print('\t metric:', train_loss, 'eq:', candidate_ode_equations)
+        results[k] = (train_loss, candidate_ode_equations, t_optimized_constants, -train_loss)
+    sys.stdout.flush()
+    return results
+
+
+class FitBudgetExceeded(BaseException):
+    """
+    raised by the objective function once the budget of the fit is spent. not an Exception, so that the optimizers can
+    not swallow it half way.
+    """
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class FitBudget(object):
+    """
+    the time and objective-evaluation budget of fitting one candidate. the objective functions wrapped by `wrap` raise
+    FitBudgetExceeded ("time_budget" or "eval_budget") instead of evaluating over the budget, and remember the best
+    constants evaluated so far, which are the result of a stopped fit.
+    time_budget: seconds from the creation of the budget. eval_budget: number of evaluations. None for no limit.
+    """
+
+    def __init__(self, time_budget=None, eval_budget=None):
+        self.start_time = time.time()
+        self.time_budget = time_budget
+        self.eval_budget = eval_budget
+        self.num_evals = 0
+        self.best_x = None
+        self.best_fun = np.inf
+
+    def elapsed(self) -> float:
+        return time.time() - self.start_time
+
+    def check(self, num_evals=1):
+        if self.eval_budget is not None and self.num_evals + num_evals > self.eval_budget:
+            raise FitBudgetExceeded('eval_budget')
+        if self.time_budget is not None and self.elapsed() > self.time_budget:
+            raise FitBudgetExceeded('time_budget')
+        self.num_evals += num_evals
+
+    def record(self, x, value):
+        if np.isfinite(value) and value < self.best_fun:
+            self.best_x, self.best_fun = np.array(x, dtype=float), float(value)
+
+    def wrap(self, objective, population=False):
+        """
+        objective: `objective(coef)`, which returns the value (or the value and the gradient), or, if population,
+                   `objective(population)`, which returns the values of all the rows of the population.
+        """
+        if self.time_budget is None and self.eval_budget is None:
+            return objective
+
+        def budgeted_objective(coef):
+            self.check(len(coef) if population else 1)
+            value = objective(coef)
+            if population:
+                for x, one_value in zip(coef, value):
+                    self.record(x, one_value)
+            else:
+                self.record(coef, value[0] if isinstance(value, tuple) else value)
+            return value
+
+        return budgeted_objective
+
+
+# the pre-fitted constants are good enough if the optimizer improves their objective by at most this fraction.
+PREFIT_RTOL = 0.01
+# the window of the Savitzky-Golay filter that smooths the time derivatives of the trajectories.
+PREFIT_WINDOW = 11
+
+
+def prefit_is_sufficient(prefit_obj, optimized_obj) -> bool:
+    if not np.isfinite(prefit_obj):
+        return False
+    return prefit_obj - optimized_obj <= PREFIT_RTOL * abs(prefit_obj)
+
+
+def smoothed_time_derivative(t_eval, trajectories):
+    """
+    the time derivative of the trajectories [batch_size, time_steps, nvars], fitted by a local cubic polynomial
+    (Savitzky-Golay filter) on a uniform time grid, so the noise on the trajectories is not amplified. the derivative
+    of a short or non-uniform grid is the central finite difference.
+    """
+    t_eval = np.asarray(t_eval, dtype=float)
+    window = min(PREFIT_WINDOW, len(t_eval) - (1 - len(t_eval) % 2))
+    dt = np.diff(t_eval)
+    if window > 3 and np.allclose(dt, dt[0]):
+        return savgol_filter(trajectories, window, polyorder=3, deriv=1, delta=dt[0], axis=1)
+    return np.gradient(trajectories, t_eval, axis=1)
+
+
+def derivative_matching_constants(expr_strs: list, c_names: list, input_var_Xs: list, t_eval, true_trajectories,
+                                  optimizer_name='BFGS', max_opt_iter=500):
+    """
+    fit the open constants c of the candidate ODEs dx/dt = f(x; c) without integrating them: minimize the normalized
+    squared distance between f on the true trajectories and their smoothed time derivatives (see
+    `smoothed_time_derivative`), sum_i mean((f_i(x; c) - dx_i/dt)^2) / var(dx_i/dt).
+    expr_strs: the expressions, where the open constants are named c_names.
+    true_trajectories: [batch_size, time_steps, nvars]
+    return the constants, or None if the candidate can not be compiled (or the fit is not finite).
+    """
+    try:
+        trees = [tree_from_str(one_expr, [str(xi) for xi in input_var_Xs], c_names) for one_expr in expr_strs]
+    except ValueError:
+        return None
+    rhs = compile_trees(trees, len(input_var_Xs), len(c_names))
+    y = np.asarray(true_trajectories, dtype=float)
+    X = np.moveaxis(y, -1, 0)
+    dydt = np.moveaxis(smoothed_time_derivative(t_eval, y), -1, 0)
+    # the components with a constant derivative are weighted as if their variance was 1.
+    scale = 1.0 / np.where(np.var(dydt, axis=(1, 2)) > 0, np.var(dydt, axis=(1, 2)), 1.0)
+
+    def objective_function(coef):
+        residual = np.stack([np.broadcast_to(fi, y.shape[:-1]) for fi in rhs(0.0, *X, *coef)]) - dydt
+        value = np.sum(np.mean(residual ** 2, axis=(1, 2)) * scale)
+        return value if np.isfinite(value) else 1e300
+
+    try:
+        opt_result = scipy_minimize(objective_function, np.random.rand(len(c_names)), optimizer_name, len(c_names),
+                                    max_opt_iter)
+    except Exception as e:
+        print(e)
+        return None
+    constants = np.asarray(opt_result['x'], dtype=float)
+    return constants if np.all(np.isfinite(constants)) and opt_result['fun'] < 1e300 else None
+
+
+def linear_least_squares_constants(expr_strs: list, c_names: list, input_var_Xs: list, t_eval, true_trajectories):
+    """
+    fit the open constants of candidate ODEs that are linear in them, dx/dt = g(x) + sum_k c_k g_k(x), in one linear
+    least squares solve on the integral form of the ODEs over every time step:
+        x(t_{n+1}) - x(t_n) = int g(x) dt + sum_k c_k int g_k(x) dt,
+    where the integrals are the trapezoid rule on the true trajectories.
+    expr_strs: the expressions, where the open constants are named c_names.
+    true_trajectories: [batch_size, time_steps, nvars]
+    return the constants, or None if the candidate is not linear in its constants (or the solve fails).
+    """
+    try:
+        trees = [tree_from_str(one_expr, [str(xi) for xi in input_var_Xs], c_names) for one_expr in expr_strs]
+    except ValueError:
+        return None
+    many_terms = [linear_in_constants(tree) for tree in trees]
+    if any(terms is None for terms in many_terms):
+        return None
+    y = np.asarray(true_trajectories, dtype=float)
+    X = np.moveaxis(y, -1, 0)
+    half_dt = np.diff(np.asarray(t_eval, dtype=float)) / 2
+
+    def integral(g):
+        values = np.broadcast_to(evaluate_tree(g, X), y.shape[:-1])
+        return (values[:, 1:] + values[:, :-1]) * half_dt
+
+    # one row per (component, trajectory, time step), one column per constant.
+    A = np.zeros((len(trees),) + y[:, 1:, 0].shape + (len(c_names),))
+    b = np.moveaxis(np.diff(y, axis=1), -1, 0)
+    for i, terms in enumerate(many_terms):
+        for k, g in terms.items():
+            if k is None:
+                b[i] -= integral(g)
+            else:
+                A[i, ..., k] = integral(g)
+    A, b = A.reshape(-1, len(c_names)), b.reshape(-1)
+    rows = np.all(np.isfinite(A), axis=1) & np.isfinite(b)
+    if not np.any(rows):
+        return None
+    constants = np.linalg.lstsq(A[rows], b[rows], rcond=None)[0]
+    return constants if np.all(np.isfinite(constants)) else None
+
+
+def compile_simulator(expr_odes: list, input_var_Xs: list, c_symbols: list, integrator_backend='numpy',
+                      integrator_method='rk4', divergence_threshold=None, precision='float64', num_function=None):
+    """
+    compile the candidate ODEs with open constants c_symbols into `simulate(t_evals, x_init_conds, coef)`,
+    which returns the trajectories [batch_size, time_steps, nvars].
+
+    integrator_backend:
+    - "numpy": lambdify the expressions and integrate all the initial conditions together.
+    the subexpressions shared by the components (e.g., X0*X1, exp(X0)) are computed once per call of the right-hand side
+    by every backend, see `sympy.cse`.
+    - "numba": jit the expressions together with a fixed-step kernel. The kernel is cached by the skeleton of the
+      expressions, so only the first candidate of every skeleton pays the compilation.
+    - "torch": lambdify the expressions to torch (float64, CPU) and integrate all the initial conditions together.
+      Mostly used by `optimize_many`, which fits the constants with autograd.
+    integrator_method: "rk4" (fixed step, both backends), "euler" (fixed step, numba only) or
+                       "rk45" (adaptive Dormand-Prince with dense output, numpy only).
+    divergence_threshold: stop integrating once the magnitude of the state exceeds it. the rest of the trajectories is
+                          filled with inf (the "diverged" result). None integrates all the steps.
+    precision: "float64", or "float32" (fixed-step methods of the numpy and numba backends) for screening candidates
+               at half the memory traffic. the trajectories are returned in this precision.
+    num_function: the right-hand side already lambdified from expr_odes (numpy backend only), e.g., rebuilt from the
+                  persisted cache. See `cached_simulator`.
+
+    coef: [num_constants], or a population [n_starts, num_constants] of constants, whose trajectories
+          [n_starts, batch_size, time_steps, nvars] are integrated as one batch over [n_starts, batch_size, nvars] by the
+          numpy rk4 integrator (one start after another otherwise). a diverged start is not stopped early, since the
+          other starts share its steps.
+    """
+    dtype = np.dtype(precision)
+    if dtype != np.float64 and (integrator_backend == 'torch' or integrator_method == 'rk45'):
+        raise NotImplementedError(precision, "is not implemented....")
+    if integrator_backend == 'numba':
+        kernel = compile_ode_kernel(expr_odes, input_var_Xs, c_symbols, method=integrator_method)
+        threshold = np.inf if divergence_threshold is None else float(divergence_threshold)
+
+        def simulate(t_evals, x_init_conds, coef):
+            if np.ndim(coef) == 2:
+                return np.stack([simulate(t_evals, x_init_conds, one_coef) for one_coef in coef])
+            return kernel(np.asarray(t_evals, dtype=dtype), np.asarray(x_init_conds, dtype=dtype),
+                          np.asarray(coef, dtype=dtype), threshold)
+
+        return simulate
+    elif integrator_backend == 'numpy':
+        if num_function is None:
+            t = symbols('t')  # not used in this case
+            num_function = lambdify((t, *input_var_Xs, *c_symbols), expr_odes, cse=True)
+        if integrator_method == 'rk4':
+            integrator = batch_runge_kutta4
+        elif integrator_method == 'rk45':
+            integrator = batch_dormand_prince
+        else:
+            raise NotImplementedError(integrator_method, "is not implemented....")
+
+        def simulate(t_evals, x_init_conds, coef):
+            # integrate all the initial conditions together, one rhs call per stage for the whole batch.
+            coef = np.asarray(coef, dtype=dtype)
+            x_init_conds = np.asarray(x_init_conds, dtype=dtype)
+            threshold = divergence_threshold
+            if coef.ndim == 2 and integrator_method != 'rk4':
+                return np.stack([simulate(t_evals, x_init_conds, one_coef) for one_coef in coef])
+            elif coef.ndim == 2:
+                # the state is [n_starts, batch_size, nvars], and every constant is a column [n_starts, 1].
+                x_init_conds = np.broadcast_to(x_init_conds, coef.shape[:1] + x_init_conds.shape)
+                coef = coef.T.reshape(coef.shape[::-1] + (1,) * (x_init_conds.ndim - 2))
+                threshold = None
+            derivative = batched_rhs(lambda t, state: num_function(t, *state, *coef))
+            return integrator(derivative, np.asarray(t_evals, dtype=dtype), x_init_conds,
+                              divergence_threshold=threshold)
+
+        return simulate
+    elif integrator_backend == 'torch':
+        import torch
+        from grammar.odeint import torch_odeint
+        if integrator_method != 'rk4':
+            raise NotImplementedError(integrator_method, "is not implemented....")
+        t = symbols('t')  # not used in this case
+        num_function = torch_odeint.lambdify_torch((t, *input_var_Xs, *c_symbols), expr_odes)
+
+        def simulate(t_evals, x_init_conds, coef):
+            if np.ndim(coef) == 2:
+                return np.stack([simulate(t_evals, x_init_conds, one_coef) for one_coef in coef])
+            coef = torch.as_tensor(np.asarray(coef, dtype=float))
+            derivative = torch_odeint.batched_rhs(lambda t, state: num_function(t, *state, *coef))
+            with torch.no_grad():
+                trajectories = torch_odeint.batch_runge_kutta4(
+                    derivative, torch.as_tensor(t_evals, dtype=torch.float64),
+                    torch.as_tensor(x_init_conds, dtype=torch.float64), divergence_threshold=divergence_threshold)
+            return trajectories.numpy()
+
+        return simulate
+    raise NotImplementedError(integrator_backend, "is not implemented....")
+
+
+def compile_sensitivity_simulator(expr_odes: list, input_var_Xs: list, c_symbols: list, integrator_backend='numpy',
+                                  integrator_method='rk4', divergence_threshold=None, precision='float64'):
+    """
+    compile the forward sensitivity system of the candidate ODEs into
+    `simulate(t_evals, x_init_conds, coef) -> (trajectories, sensitivities)`.
+    with dx/dt = f(x, c) and S = dx/dc, the sensitivities follow dS/dt = df/dx * S + df/dc and S(0) = 0.
+    both Jacobians are derived symbolically, and the augmented system [x, S] is integrated with the same integrator as
+    `compile_simulator`, so the gradient is exact for the discretized trajectories.
+
+    trajectories: [batch_size, time_steps, nvars]
+    sensitivities: [batch_size, time_steps, nvars, num_constants]
+    divergence_threshold: only checked on the trajectories, since the sensitivities of a bounded trajectory may still
+                          be large. the augmented system is integrated through, and a diverged candidate gets inf for
+                          the whole result.
+    """
+    nvars, nconsts = len(input_var_Xs), len(c_symbols)
+    S = [[Symbol('S_{}_{}'.format(i, k)) for k in range(nconsts)] for i in range(nvars)]
+    jac_x = [[diff(one_ode, xj) for xj in input_var_Xs] for one_ode in expr_odes]
+    sensitivity_odes = [sum((jac_x[i][j] * S[j][k] for j in range(nvars)), diff(expr_odes[i], c_symbols[k]))
+                        for i in range(nvars) for k in range(nconsts)]
+    augmented_Xs = list(input_var_Xs) + [S[i][k] for i in range(nvars) for k in range(nconsts)]
+    simulate_augmented = compile_simulator(list(expr_odes) + sensitivity_odes, augmented_Xs, c_symbols,
+                                           integrator_backend, integrator_method, None, precision)
+
+    def simulate(t_evals, x_init_conds, coef):
+        augmented_inits = np.concatenate([x_init_conds, np.zeros((x_init_conds.shape[0], nvars * nconsts))], axis=-1)
+        augmented_trajectories = simulate_augmented(t_evals, augmented_inits, coef)
+        if divergence_threshold is not None and has_diverged(augmented_trajectories[..., :nvars], divergence_threshold):
+            augmented_trajectories = np.full_like(augmented_trajectories, np.inf)
+        sensitivities = augmented_trajectories[..., nvars:].reshape(augmented_trajectories.shape[:-1] + (nvars, nconsts))
+        return augmented_trajectories[..., :nvars], sensitivities
+
+    return simulate
+
+
+def cached_simulator(skeleton_strs: list, input_var_Xs: list, c_names: list, integrator_backend='numpy',
+                     integrator_method='rk4', divergence_threshold=None, precision='float64', sensitivity=False):
+    """
+    `compile_simulator` (or `compile_sensitivity_simulator` if sensitivity) of the skeleton expressions, looked up in the
+    process-wide cache of compiled expressions first, so a skeleton is parsed and lambdified once per process.
+    skeleton_strs: the expressions as strings, where the open constants are named c_names. See `canonical_skeleton`.
+    the generated numpy code is kept as the metadata of the entry, so it can be persisted across runs.
+    """
+    integrator_kwargs = {'integrator_backend': integrator_backend,
+                         'integrator_method': integrator_method,
+                         'divergence_threshold': divergence_threshold,
+                         'precision': precision}
+    key = (tuple(skeleton_strs), tuple(str(xi) for xi in input_var_Xs), tuple(c_names),
+           integrator_backend, integrator_method, divergence_threshold, precision, sensitivity)
+    c_symbols = [Symbol(ci) for ci in c_names]
+
+    def build(source):
+        if integrator_backend == 'numpy' and not sensitivity:
+            if source is None:
+                try:
+                    # compiled from the expression tree, without sympy.
+                    trees = [tree_from_str(one_expr, [str(xi) for xi in input_var_Xs], c_names)
+                             for one_expr in skeleton_strs]
+                    source = tree_source(trees, len(input_var_Xs), len(c_names))
+                    num_function = compile_source(source)
+                except ValueError:
+                    # some function the tree does not know: lambdify it with sympy.
+                    expr_odes = [parse_expr(one_expr) for one_expr in skeleton_strs]
+                    t = symbols('t')  # not used in this case
+                    num_function = lambdify((t, *input_var_Xs, *c_symbols), expr_odes, cse=True)
+                    source = rhs_source(num_function)
+            else:
+                num_function = rhs_from_source(source)
+            return compile_simulator(None, input_var_Xs, c_symbols, num_function=num_function,
+                                     **integrator_kwargs), source
+        expr_odes = [parse_expr(one_expr) for one_expr in skeleton_strs]
+        if sensitivity:
+            return compile_sensitivity_simulator(expr_odes, input_var_Xs, c_symbols, **integrator_kwargs), None
+        return compile_simulator(expr_odes, input_var_Xs, c_symbols, **integrator_kwargs), None
+
+    return compiled_expressions.get(key, build)
+
+
 def execute(expr_strs: list[str], x_init_conds: np.ndarray, time_span: tuple, t_evals: np.ndarray,
-            input_var_Xs: list) -> np.ndarray:
+            input_var_Xs: list, integrator_backend='numpy', integrator_method='rk4',
+            divergence_threshold=None, precision='float64') -> np.ndarray:
     """
     given a symbolic ODE (func) and the initial condition (init_cond), compute the time trajectory.
 
@@ -150,52 +711,383 @@ def execute(expr_strs: list[str], x_init_conds: np.ndarray, time_span: tuple, t_
     t_evals: np.linspace, or np.logspace
     x_init_conds: [batch_size, nvars]
     pred_trajectories: [batch_size, time_steps, nvars]
+    integrator_backend, integrator_method, divergence_threshold, precision: see `compile_simulator`.
     """
     # sttime=time.time()
 
-    expr_odes = [parse_expr(one_expr) for one_expr in expr_strs]
-    t = symbols('t')  # not used in this case
+    # fitted constants are abstracted, so the equations of the same skeleton reuse the compiled code.
+    skeleton_strs, c_names, c_values = canonical_skeleton(expr_strs)
     try:
-        func = lambdify((t, input_var_Xs), expr_odes)
-        pred_trajectories = []
-        for one_x_init in x_init_conds:
-            # one_solution = runge_kutta4(func, t_evals, one_x_init)
-            # one_solution = solve_ivp(func, t_span=time_span, t_evals=t_evals, y0=one_x_init, method='RK45')
-            # pred_trajectories.append(one_solution.y)
-            one_solution = runge_kutta4(func, t_evals, one_x_init)
-            pred_trajectories.append(one_solution)
-        pred_trajectories = np.asarray(pred_trajectories)
+        simulate = cached_simulator(skeleton_strs, input_var_Xs, c_names, integrator_backend, integrator_method,
+                                    divergence_threshold, precision)
+        pred_trajectories = simulate(t_evals, x_init_conds, c_values)
 
         if pred_trajectories is complex:
-            pred_trajectories = np.ones(x_init_conds.shape[0], t_evals.shape[0], x_init_conds.shape[1]) * -np.infty
+            pred_trajectories = np.full((x_init_conds.shape[0], t_evals.shape[0], x_init_conds.shape[1]), -np.inf)
             return pred_trajectories
             # return np.ones(init_cond.shape[-1]) * np.infty
     except TypeError as e:
         # print(e, expr, input_var_Xs, data_X.shape)
-        pred_trajectories = np.ones(x_init_conds.shape[0], t_evals.shape[0], x_init_conds.shape[1]) * -np.infty
+        pred_trajectories = np.full((x_init_conds.shape[0], t_evals.shape[0], x_init_conds.shape[1]), -np.inf)
         return pred_trajectories
     except KeyError as e:
         # print(e, expr)
-        pred_trajectories = np.ones(x_init_conds.shape[0], t_evals.shape[0], x_init_conds.shape[1]) * -np.infty
+        pred_trajectories = np.full((x_init_conds.shape[0], t_evals.shape[0], x_init_conds.shape[1]), -np.inf)
         return pred_trajectories
     except ValueError as e:
-        pred_trajectories = np.ones(x_init_conds.shape[0], t_evals.shape[0], x_init_conds.shape[1]) * -np.infty
+        pred_trajectories = np.full((x_init_conds.shape[0], t_evals.shape[0], x_init_conds.shape[1]), -np.inf)
         return pred_trajectories
+    except (NumbaError, PrintMethodNotImplementedError) as e:
+        # the expression can not be printed, typed or lowered by numba: integrate it with the numpy backend instead.
+        if integrator_backend == 'numba' and integrator_method == 'rk4':
+            return execute(expr_strs, x_init_conds, time_span, t_evals, input_var_Xs, 'numpy', integrator_method,
+                           divergence_threshold, precision)
+        pred_trajectories = np.full((x_init_conds.shape[0], t_evals.shape[0], x_init_conds.shape[1]), -np.inf)
+        return pred_trajectories
+    return pred_trajectories
+
+
+def execute_many(many_expr_strs: list, x_init_conds: np.ndarray, time_span: tuple, t_evals: np.ndarray,
+                 input_var_Xs: list, integrator_backend='numpy', integrator_method='rk4',
+                 divergence_threshold=None, precision='float64') -> np.ndarray:
+    """
+    compute the time trajectories of many candidate ODEs (with the same nvars) in one stacked pass.
+    the variables of the k-th candidate are the k-th block of nvars variables in the stacked state, so all the
+    candidates share one right-hand side and the state [batch_size, n_candidates * nvars] is integrated together on the
+    shared t_evals grid.
+
+    many_expr_strs: list of candidates. each candidate is a list of strings, one string per expression.
+    x_init_conds: [batch_size, nvars]
+    pred_trajectories: [n_candidates, batch_size, time_steps, nvars]. candidates that can not be compiled get -inf.
+    integrator_backend, integrator_method, divergence_threshold, precision: see `compile_simulator`. the stacked pass
+    is only for the numpy RK4 without divergence check (one exploding candidate would stop, or shrink the adaptive
+    steps of, the whole stack); otherwise every candidate is integrated on its own.
+    """
+    nvars = len(input_var_Xs)
+    batch_size = x_init_conds.shape[0]
+    pred_trajectories = np.full((len(many_expr_strs), batch_size, t_evals.shape[0], nvars), -np.inf, dtype=precision)
+    if integrator_backend != 'numpy' or integrator_method != 'rk4' or divergence_threshold is not None:
+        for k, expr_strs in enumerate(many_expr_strs):
+            try:
+                pred_trajectories[k] = execute(expr_strs, x_init_conds, time_span, t_evals, input_var_Xs,
+                                               integrator_backend, integrator_method, divergence_threshold, precision)
+            except Exception:
+                continue
+        return pred_trajectories
+
+    var_names = [str(xi) for xi in input_var_Xs]
+    compiled_idx, stacked_trees, separate_idx = [], [], []
+    for k, expr_strs in enumerate(many_expr_strs):
+        try:
+            trees = [tree_from_str(one_expr, var_names) for one_expr in expr_strs]
+        except ValueError:
+            # placeholders left in the expression, or a function the tree does not know.
+            separate_idx.append(k)
+            continue
+        if len(trees) != nvars:
+            continue
+        stacked_trees.extend([offset_variables(tree, len(compiled_idx) * nvars) for tree in trees])
+        compiled_idx.append(k)
+    for k in separate_idx:
+        try:
+            pred_trajectories[k] = execute(many_expr_strs[k], x_init_conds, time_span, t_evals, input_var_Xs,
+                                           precision=precision)
+        except Exception:
+            continue
+    if not compiled_idx:
+        return pred_trajectories
+
+    try:
+        stacked_function = compile_trees(stacked_trees, len(compiled_idx) * nvars)
+        func = lambda t, state: stacked_function(t, *state)
+        stacked_inits = np.tile(x_init_conds, (1, len(compiled_idx))).astype(precision)
+        stacked_trajectories = batch_runge_kutta4(batched_rhs(func), np.asarray(t_evals, dtype=precision),
+                                                  stacked_inits)
+        stacked_trajectories = stacked_trajectories.reshape(batch_size, t_evals.shape[0], len(compiled_idx), nvars)
+        pred_trajectories[compiled_idx] = np.transpose(stacked_trajectories, (2, 0, 1, 3))
+    except (TypeError, KeyError, ValueError, NameError) as e:
+        # one bad candidate should not spoil the whole stack; fall back to integrate them one by one.
+        for k in compiled_idx:
+            pred_trajectories[k] = execute(many_expr_strs[k], x_init_conds, time_span, t_evals, input_var_Xs,
+                                           precision=precision)
     return pred_trajectories
 
 
-def scipy_minimize(f, x0, optimizer, num_changing_consts, max_opt_iter):
+# the number of the best starts refined together, the iterations of their refinement, and when the refined starts
+# agree on the objective.
+MULTI_START_REFINE = 16
+MULTI_START_ITERS = 30
+MULTI_START_RTOL = 1e-3
+MULTI_START_ATOL = 1e-12
+
+
+def multi_start_minimize(population_objective, minimize_from, starts, fd_step=1e-6):
+    """
+    rank the starts [n_starts, num_constants] by their objective, all computed at once by
+    `population_objective(starts)`, and refine the best MULTI_START_REFINE of them together (see `population_descent`)
+    until the best two agree on the objective. only the best refined start is optimized by `minimize_from(x0)`, so the
+    cost stays close to the one of a single start.
+    """
+    start_objs = _finite_or_inf(population_objective(starts))
+    best_idx = np.argsort(start_objs, kind='stable')[:MULTI_START_REFINE]
+    refined, _ = population_descent(population_objective, starts[best_idx], start_objs[best_idx], MULTI_START_ITERS,
+                                    fd_step)
+    return minimize_from(refined[0])
+
+
+def population_descent(population_objective, x, fx, num_iters, fd_step=1e-6, step_factors=(4, 1, 0.25, 0.0625)):
+    """
+    a few steepest descent iterations of all the starts x [k, num_constants] at once. every iteration calls
+    `population_objective` twice: on the forward-difference probes of all the starts, then on the steps of all the
+    starts along their gradient, whose length is the step radius of the start times each of step_factors.
+    a start moves to its best step if it improves (and the radius follows the step), otherwise its radius shrinks.
+    stop early when the best two starts agree on the objective.
+    return the starts and their objectives, from the best to the worst.
+    """
+    k, n = x.shape
+    x, fx = x.copy(), np.asarray(fx, dtype=float).copy()
+    radius = np.maximum(np.abs(x).max(axis=1), 1.0) * 0.1
+    step_factors = np.asarray(step_factors, dtype=float)
+    for _ in range(num_iters):
+        order = np.argsort(fx, kind='stable')
+        if k > 1 and np.isclose(fx[order[0]], fx[order[1]], rtol=MULTI_START_RTOL, atol=MULTI_START_ATOL):
+            break
+        h = fd_step * np.maximum(np.abs(x), 1.0)
+        probes = x[:, None, :] + np.eye(n)[None] * h[:, None, :]
+        grad = (_finite_or_inf(population_objective(probes.reshape(-1, n))).reshape(k, n) - fx[:, None]) / h
+        grad[~np.isfinite(grad)] = 0.0
+        direction = -grad / np.maximum(np.linalg.norm(grad, axis=1, keepdims=True), 1e-300)
+        lengths = radius[:, None] * step_factors[None, :]
+        steps = x[:, None, :] + lengths[..., None] * direction[:, None, :]
+        f_steps = _finite_or_inf(population_objective(steps.reshape(-1, n))).reshape(k, len(step_factors))
+        best_step = np.argmin(f_steps, axis=1)
+        improved = f_steps[np.arange(k), best_step] < fx
+        x[improved] = steps[improved, best_step[improved]]
+        fx[improved] = f_steps[improved, best_step[improved]]
+        radius = np.where(improved, lengths[np.arange(k), best_step], radius * step_factors[-1])
+    order = np.argsort(fx, kind='stable')
+    return x[order], fx[order]
+
+
+# differential evolution: the members of a population per open constant, the range of the weight of the difference
+# (drawn again every generation), the crossover probability, and when the objectives of a population agree (the same
+# as the defaults of scipy). `optimize_population` stacks candidates while the state of the stack is at most
+# EVOLUTION_MAX_STACK numbers: a larger stack costs as much as its candidates one by one, since every candidate adds its
+# own operations to the right-hand side, and only the per-operation overhead of numpy is shared.
+EVOLUTION_POPSIZE = 10
+EVOLUTION_MUTATION = (0.5, 1.0)
+EVOLUTION_RECOMBINATION = 0.7
+EVOLUTION_TOL = 0.01
+EVOLUTION_ATOL = 1e-12
+EVOLUTION_MAX_STACK = 2 ** 13
+
+
+def evolution_first_generation(num_constants, init_constants):
+    """
+    the first generation [K, EVOLUTION_POPSIZE * num_constants, num_constants] of K populations, spread over the same
+    box as the global optimizers. init_constants: the K constants (or None) put first in every population.
+    """
+    popsize = max(EVOLUTION_POPSIZE * num_constants, 5)
+    members = np.random.uniform(-5, 5, (len(init_constants), popsize, num_constants))
+    for k, x0 in enumerate(init_constants):
+        if x0 is not None and np.shape(x0) == (num_constants,) and np.all(np.isfinite(x0)):
+            members[k, 0] = x0
+    return members
+
+
+def population_evolution(population_objective, members, num_generations):
+    """
+    differential evolution (DE/rand/1/bin) of K independent populations at once. every generation calls
+    `population_objective(trials, populations)` once, on the trial members [k, P, num_constants] of the k populations
+    still evolving, whose indices (among the K) are populations. it returns their objectives [k, P] (lower is better).
+    a trial member replaces its parent if it is not worse. a population stops evolving once its objectives agree within
+    EVOLUTION_TOL, and the evolution stops once all of them do, or after num_generations.
+    members: the first generation [K, P, num_constants], see `evolution_first_generation`.
+    return the best member [K, num_constants] of every population and its objective [K].
+    """
+    members = np.array(members, dtype=float)
+    num_populations, popsize, num_constants = members.shape
+    objs = _finite_or_inf(population_objective(members, np.arange(num_populations))).reshape(num_populations, popsize)
+    evolving = np.arange(num_populations)
+    for _ in range(num_generations):
+        finite = np.where(np.isfinite(objs[evolving]), objs[evolving], np.nan)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            converged = np.nanstd(finite, axis=1) <= EVOLUTION_ATOL + EVOLUTION_TOL * np.abs(np.nanmean(finite, axis=1))
+        evolving = evolving[~converged]
+        if len(evolving) == 0:
+            break
+        parents = members[evolving]
+        # three other members of the same population for every member.
+        picks = np.random.rand(len(evolving), popsize, popsize)
+        picks[:, np.arange(popsize), np.arange(popsize)] = np.inf
+        r0, r1, r2 = np.moveaxis(np.argsort(picks, axis=2)[..., :3], -1, 0)
+        population_idx = np.arange(len(evolving))[:, None]
+        weight = np.random.uniform(*EVOLUTION_MUTATION)
+        mutants = parents[population_idx, r0] + weight * (parents[population_idx, r1] - parents[population_idx, r2])
+        crossover = np.random.rand(len(evolving), popsize, num_constants) < EVOLUTION_RECOMBINATION
+        crossover[population_idx, np.arange(popsize)[None], np.random.randint(num_constants, size=(1, popsize))] = True
+        trials = np.where(crossover, mutants, parents)
+        trial_objs = _finite_or_inf(population_objective(trials, evolving)).reshape(len(evolving), popsize)
+        replaced = trial_objs <= objs[evolving]
+        parents[replaced] = trials[replaced]
+        members[evolving] = parents
+        objs[evolving] = np.where(replaced, trial_objs, objs[evolving])
+    best_idx = np.argmin(objs, axis=1)
+    population_idx = np.arange(num_populations)
+    return members[population_idx, best_idx], objs[population_idx, best_idx]
+
+
+def optimize_population(many_candidate_ode_equations: list, init_cond, time_span, t_eval, true_trajectories,
+                        input_var_Xs, loss_func, max_open_constants, max_opt_iter,
+                        optimizer_name,
+                        non_terminal_nodes,
+                        user_scpeficied_iters=-1,
+                        init_constants=None,
+                        integrator_backend='numpy',
+                        integrator_method='rk4',
+                        divergence_threshold=None,
+                        precision='float64'):
+    """
+    fit the constants of many candidates with `population_evolution` (for the numpy rk4 integrator), where the
+    candidates with the same number of open constants (a skeleton class) evolve together: the variables and the
+    constants of the k-th candidate of a class are the k-th block of one stacked state and constant vector, as in
+    `execute_many`, so one simulation of the stacked right-hand side evaluates one generation of all their populations.
+    init_constants: None, or the constants (or None) every candidate starts from, put in its first generation.
+    the other parameters and the return are the same as `optimize_many`. the candidates without constants, or which the
+    expression tree can not compile, are fitted one by one by `optimize`.
+    """
+    integrator_kwargs = {'integrator_backend': integrator_backend,
+                         'integrator_method': integrator_method,
+                         'divergence_threshold': divergence_threshold,
+                         'precision': precision}
+    if user_scpeficied_iters > 0:
+        max_opt_iter = user_scpeficied_iters
+    init_cond = np.asarray(init_cond, dtype=precision)
+    true_trajectories = np.asarray(true_trajectories, dtype=precision)
+    var_ytrue = np.var(true_trajectories)
+    var_names = [str(xi) for xi in input_var_Xs]
+    nvars = len(var_names)
+    if init_constants is None:
+        init_constants = [None] * len(many_candidate_ode_equations)
+    results = [None] * len(many_candidate_ode_equations)
+    classes = {}
+    for k, candidate_ode_equations in enumerate(many_candidate_ode_equations):
+        candidate_ode_equations = simplify_template(candidate_ode_equations)
+        numbered_ode_equations, c_names = number_constants(candidate_ode_equations)
+        trees = None
+        if len(c_names) > 0 and not check_non_terminal_nodes(candidate_ode_equations, non_terminal_nodes):
+            try:
+                trees = [tree_from_str(one_expr, var_names, c_names) for one_expr in numbered_ode_equations]
+            except ValueError:
+                # a function the tree does not know.
+                pass
+        if len(c_names) >= max_open_constants:
+            # discourage over expressions with too many coefficients.
+            results[k] = (-np.inf, candidate_ode_equations, 0, np.inf)
+        elif trees is None:
+            # nothing to fit together with the others.
+            results[k] = optimize(candidate_ode_equations, init_cond, time_span, t_eval, true_trajectories,
+                                  input_var_Xs, loss_func, max_open_constants, max_opt_iter, optimizer_name,
+                                  non_terminal_nodes, init_constants=init_constants[k], **integrator_kwargs)
+        else:
+            print("candidate:", candidate_ode_equations)
+            classes.setdefault(len(c_names), []).append((k, numbered_ode_equations, c_names, trees))
+
+    def fit_stack(stack, num_constants):
+        # evolve the populations of the candidates of one class together.
+        simulators = {}
+
+        def stacked_simulator(populations):
+            # the stacked right-hand side of the populations still evolving, compiled from the trees;
+            # compile_simulator only integrates it.
+            if populations not in simulators:
+                stacked_trees = [offset_constants(offset_variables(tree, j * nvars), j * num_constants)
+                                 for j, k in enumerate(populations) for tree in stack[k][3]]
+                num_function = compile_trees(stacked_trees, len(populations) * nvars, len(populations) * num_constants)
+                simulators[populations] = compile_simulator(None, None, None, precision=precision,
+                                                            num_function=num_function)
+            return simulators[populations]
+
+        def population_objective(members, populations):
+            # the member p of all the populations is the row p of the stacked constants.
+            coef = np.transpose(members, (1, 0, 2)).reshape(members.shape[1], -1)
+            stacked_inits = np.tile(init_cond, (1, len(populations)))
+            stacked_trajectories = stacked_simulator(tuple(populations))(t_eval, stacked_inits, coef)
+            return [[-loss_func(pred_trajectories[..., j * nvars:(j + 1) * nvars], true_trajectories, var_ytrue)
+                     for pred_trajectories in stacked_trajectories] for j in range(len(populations))]
+
+        first_generation = evolution_first_generation(num_constants, [init_constants[k] for k, _, _, _ in stack])
+        return population_evolution(population_objective, first_generation, max_opt_iter)
+
+    for num_constants, members in classes.items():
+        popsize = max(EVOLUTION_POPSIZE * num_constants, 5)
+        stack_size = max(1, EVOLUTION_MAX_STACK // (popsize * init_cond.size))
+        for start in range(0, len(members), stack_size):
+            stack = members[start:start + stack_size]
+            fitted = {}
+            try:
+                best_x, best_obj = fit_stack(stack, num_constants)
+                fitted = {j: (best_x[j], best_obj[j]) for j in range(len(stack))}
+            except (TypeError, KeyError, ValueError, NameError) as e:
+                # one bad candidate should not spoil the whole stack; fall back to fit them one by one.
+                for j in range(len(stack)):
+                    try:
+                        best_x, best_obj = fit_stack(stack[j:j + 1], num_constants)
+                        fitted[j] = (best_x[0], best_obj[0])
+                    except (TypeError, KeyError, ValueError, NameError) as e:
+                        print(e)
+            for j, (k, numbered_ode_equations, c_names, _) in enumerate(stack):
+                if j not in fitted:
+                    results[k] = (-np.inf, numbered_ode_equations, 0, np.inf)
+                    continue
+                t_optimized_constants, t_optimized_obj = fitted[j]
+                try:
+                    eq_est = substitute_constants(numbered_ode_equations, c_names, t_optimized_constants)
+                    pred_trajectories = execute(eq_est, init_cond, time_span, t_eval, input_var_Xs,
+                                                **integrator_kwargs)
+                    candidate_ode_equations = [pretty_print_expr(parse_expr(one_expr)) for one_expr in eq_est]
+                except Exception as e:
+                    print(e)
+                    results[k] = (-np.inf, numbered_ode_equations, 0, np.inf)
+                    continue
+                train_loss = loss_func(pred_trajectories, true_trajectories, var_ytrue)
+                print('\t metric:', train_loss, 'eq:', candidate_ode_equations)
+                results[k] = (train_loss, candidate_ode_equations, t_optimized_constants, t_optimized_obj)
+    sys.stdout.flush()
+    return results
+
+
+def _finite_or_inf(values):
+    values = np.asarray(values, dtype=float).copy()
+    values[~np.isfinite(values)] = np.inf
+    return values
+
+
+def scipy_minimize(f, x0, optimizer, num_changing_consts, max_opt_iter, jac=False, finite_diff_step=None):
     # optimize the open constants in the expression
+    # jac=True: f returns (value, gradient). only the gradient-based optimizers (BFGS, CG, L-BFGS-B) use the gradient.
+    # finite_diff_step: step of the finite-difference gradient of BFGS, CG and L-BFGS-B. None uses the scipy default.
+    # a larger step (for a low-precision objective) also loosens the gradient tolerance, since the gradient can not be
+    # resolved below its round-off.
     opt_result = None
+    fd_options = {}
+    if finite_diff_step is not None:
+        fd_options = {'eps': finite_diff_step, 'gtol': 10 * finite_diff_step}
+    if jac and optimizer in ['BFGS', 'CG', 'L-BFGS-B']:
+        return minimize(f, x0, method=optimizer, jac=True, options={'maxiter': max_opt_iter})
+    elif jac:
+        f_and_grad = f
+        f = lambda x: f_and_grad(x)[0]
     if optimizer == 'Nelder-Mead':
         opt_result = minimize(f, x0, method='Nelder-Mead',
                               options={'xatol': 1e-10, 'fatol': 1e-10, 'maxiter': max_opt_iter})
     elif optimizer == 'BFGS':
-        opt_result = minimize(f, x0, method='BFGS', options={'maxiter': max_opt_iter})
+        opt_result = minimize(f, x0, method='BFGS', options={'maxiter': max_opt_iter, **fd_options})
     elif optimizer == 'CG':
-        opt_result = minimize(f, x0, method='CG', options={'maxiter': max_opt_iter})
+        opt_result = minimize(f, x0, method='CG', options={'maxiter': max_opt_iter, **fd_options})
     elif optimizer == 'L-BFGS-B':
-        opt_result = minimize(f, x0, method='L-BFGS-B', options={'maxiter': max_opt_iter})
+        opt_result = minimize(f, x0, method='L-BFGS-B', options={'maxiter': max_opt_iter, **fd_options})
     elif optimizer == "basinhopping":
         minimizer_kwargs = {"method": "Nelder-Mead",
                             "options": {'xatol': 1e-10, 'fatol': 1e-10, 'maxiter': 100}}
@@ -219,31 +1111,10 @@ def scipy_minimize(f, x0, optimizer, num_changing_consts, max_opt_iter):
         up = [10] * num_changing_consts
         bounds = list(zip(lw, up))
         opt_result = direct(f, bounds, maxiter=max_opt_iter)
+    elif optimizer == 'differential_evolution':
+        # one population, whose members are evaluated one by one. See `population_evolution`.
+        best_x, best_obj = population_evolution(lambda members, _: np.asarray([[f(x) for x in members[0]]]),
+                                                evolution_first_generation(num_changing_consts, [x0]), max_opt_iter)
+        opt_result = {'x': best_x[0], 'fun': best_obj[0]}
 
     return opt_result
-
-
-def simplify_template(equations: list) -> list:
-    new_equations = []
-    for eq in equations:
-        for i in range(10):
-            eq = eq.replace('(C+C)', 'C')
-            eq = eq.replace('(C-C)', 'C')
-            #
-            eq = eq.replace('C*C', 'C')
-            eq = eq.replace('(C)*C', 'C')
-            eq = eq.replace('C*(C)', 'C')
-            eq = eq.replace('(C)*(C)', 'C')
-            #
-            eq = eq.replace('C/C', 'C')
-            eq = eq.replace('(C)/C', 'C')
-            eq = eq.replace('C/(C)', 'C')
-            eq = eq.replace('(C)/(C)', 'C')
-            eq = eq.replace('sqrt(C)', 'C')
-            eq = eq.replace('exp(C)', 'C')
-            eq = eq.replace('log(C)', 'C')
-            eq = eq.replace('sin(C)', 'C')
-            eq = eq.replace('cos(C)', 'C')
-            eq = eq.replace('(1/C)', 'C')
-        new_equations.append(eq)
-    return new_equations
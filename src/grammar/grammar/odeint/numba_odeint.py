@@ -0,0 +1,128 @@
+"""compile candidate ODEs into Numba-jitted right-hand sides and fixed-step integrators."""
+from functools import lru_cache
+
+import numpy as np
+from numba import njit
+from sympy import Symbol, cse, numbered_symbols
+from sympy.parsing.sympy_parser import parse_expr
+from sympy.printing.numpy import NumPyPrinter
+
+
+def rhs_source(expr_odes: list, input_var_Xs: list, c_symbols: list) -> str:
+    """
+    python source of the right-hand side `rhs(t, y, c, dy)`, which writes the derivative of the state `y` into `dy`.
+    the subexpressions shared by the components are assigned to locals first, so they are computed once.
+    """
+    printer = NumPyPrinter()
+    replacements, reduced_odes = cse(expr_odes, symbols=numbered_symbols('_cse'))
+    lines = ['def rhs(t, y, c, dy):']
+    lines += ['    {} = y[{}]'.format(xi, i) for i, xi in enumerate(input_var_Xs)]
+    lines += ['    {} = c[{}]'.format(ci, i) for i, ci in enumerate(c_symbols)]
+    lines += ['    {} = {}'.format(sub, printer.doprint(sub_expr)) for sub, sub_expr in replacements]
+    lines += ['    dy[{}] = {}'.format(i, printer.doprint(one_ode)) for i, one_ode in enumerate(reduced_odes)]
+    return '\n'.join(lines)
+
+
+def compile_ode_kernel(expr_odes: list, input_var_Xs: list, c_symbols: list = (), method='rk4'):
+    """
+    compile the candidate ODEs into a jitted kernel `kernel(times, x_inits, c, divergence_threshold)`.
+    x_inits: [batch_size, nvars]
+    c: values of the open constants c_symbols.
+    divergence_threshold: once the magnitude of a state exceeds it (or is NaN), the integration stops and the rest of
+    the trajectories is filled with inf. Pass np.inf to integrate all the steps.
+    return of the kernel: [batch_size, time_steps, nvars]
+    the compiled kernel is cached by the skeleton, so changing only the constants reuses the compiled code.
+    """
+    return _compile_ode_kernel(tuple(str(one_ode) for one_ode in expr_odes),
+                               tuple(str(xi) for xi in input_var_Xs),
+                               tuple(str(ci) for ci in c_symbols),
+                               method)
+
+
+@lru_cache(maxsize=1024)
+def _compile_ode_kernel(skeleton_strs: tuple, var_names: tuple, const_names: tuple, method: str):
+    symbol_table = {name: Symbol(name) for name in var_names + const_names}
+    expr_odes = [parse_expr(one_expr, local_dict=symbol_table) for one_expr in skeleton_strs]
+    input_var_Xs = [symbol_table[name] for name in var_names]
+    c_symbols = [symbol_table[name] for name in const_names]
+    namespace = {'numpy': np}
+    exec(rhs_source(expr_odes, input_var_Xs, c_symbols), namespace)
+    # numpy error model: division by zero gives inf/nan instead of raising, same as the numpy backend.
+    rhs = njit(error_model='numpy')(namespace['rhs'])
+    if method == 'euler':
+        return _make_euler_kernel(rhs)
+    elif method == 'rk4':
+        return _make_rk4_kernel(rhs)
+    raise NotImplementedError(method, "is not implemented....")
+
+
+@njit
+def _has_diverged(state, divergence_threshold):
+    for j in range(state.shape[0]):
+        if not abs(state[j]) <= divergence_threshold:
+            return True
+    return False
+
+
+@njit
+def _fill_diverged(y, b, i):
+    # the loss of a candidate is over all the trajectories, so one diverged trajectory settles all of them.
+    y[b, i:] = np.inf
+    y[b + 1:] = np.inf
+
+
+def _make_euler_kernel(rhs):
+    @njit(error_model='numpy')
+    def kernel(times, x_inits, c, divergence_threshold):
+        batch_size, nvars = x_inits.shape
+        n = len(times)
+        y = np.zeros((batch_size, n, nvars), dtype=x_inits.dtype)
+        k1 = np.empty(nvars, dtype=x_inits.dtype)
+        for b in range(batch_size):
+            y[b, 0] = x_inits[b]
+            for i in range(n - 1):
+                h = times[i + 1] - times[i]
+                rhs(times[i], y[b, i], c, k1)
+                for j in range(nvars):
+                    y[b, i + 1, j] = y[b, i, j] + h * k1[j]
+                if _has_diverged(y[b, i + 1], divergence_threshold):
+                    _fill_diverged(y, b, i + 1)
+                    return y
+        return y
+
+    return kernel
+
+
+def _make_rk4_kernel(rhs):
+    @njit(error_model='numpy')
+    def kernel(times, x_inits, c, divergence_threshold):
+        batch_size, nvars = x_inits.shape
+        n = len(times)
+        y = np.zeros((batch_size, n, nvars), dtype=x_inits.dtype)
+        k1 = np.empty(nvars, dtype=x_inits.dtype)
+        k2 = np.empty(nvars, dtype=x_inits.dtype)
+        k3 = np.empty(nvars, dtype=x_inits.dtype)
+        k4 = np.empty(nvars, dtype=x_inits.dtype)
+        tmp = np.empty(nvars, dtype=x_inits.dtype)
+        for b in range(batch_size):
+            y[b, 0] = x_inits[b]
+            for i in range(n - 1):
+                h = times[i + 1] - times[i]
+                rhs(times[i], y[b, i], c, k1)
+                for j in range(nvars):
+                    tmp[j] = y[b, i, j] + k1[j] * h / 2
+                rhs(times[i] + h / 2, tmp, c, k2)
+                for j in range(nvars):
+                    tmp[j] = y[b, i, j] + k2[j] * h / 2
+                rhs(times[i] + h / 2, tmp, c, k3)
+                for j in range(nvars):
+                    tmp[j] = y[b, i, j] + k3[j] * h
+                rhs(times[i] + h, tmp, c, k4)
+                for j in range(nvars):
+                    y[b, i + 1, j] = y[b, i, j] + h / 6 * (k1[j] + 2 * k2[j] + 2 * k3[j] + k4[j])
+                if _has_diverged(y[b, i + 1], divergence_threshold):
+                    _fill_diverged(y, b, i + 1)
+                    return y
+        return y
+
+    return kernel
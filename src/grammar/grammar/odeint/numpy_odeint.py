@@ -36,6 +36,211 @@ def runge_kutta4(func, times, x_init):
     return y
 
 
+def batched_rhs(func):
+    """
+    wrap a lambdified right-hand side `func(t, [X0, X1, ...])` so that it maps a state array of shape [..., nvars]
+    to its time derivative of the same shape. Every variable row holds the whole batch, so `func` is called once per
+    stage for all the trajectories. Constant components (e.g., `0.5`) are broadcast over the batch.
+    raise ValueError if `func` does not return one component per variable.
+    """
+
+    def derivative(t, state, out=None):
+        # out: write the derivative into this buffer instead of a new array. See `runge_kutta4_inplace`.
+        components = func(t, np.moveaxis(state, -1, 0))
+        if len(components) != state.shape[-1]:
+            raise ValueError("the right-hand side has {} components for {} variables".format(len(components),
+                                                                                           state.shape[-1]))
+        dstate = np.empty_like(state) if out is None else out
+        for i, di in enumerate(components):
+            dstate[..., i] = di
+        return dstate
+
+    return derivative
+
+
+def as_float_array(x) -> np.ndarray:
+    """
+    keep a floating point array (float32 or float64) in its precision; anything else becomes float64.
+    """
+    x = np.asarray(x)
+    return x if np.issubdtype(x.dtype, np.floating) else x.astype(float)
+
+
+def has_diverged(state, divergence_threshold) -> bool:
+    """
+    the state is diverged if any entry is inf/NaN or its magnitude exceeds the threshold.
+    """
+    return not np.all(np.abs(state) <= divergence_threshold)
+
+
+def batch_runge_kutta4(func, times, x_inits, divergence_threshold=None, check_every=1):
+    """
+    solve a batch of initial conditions at once.
+    func: maps (t, state) to the derivative, where state has the shape [..., nvars]. See `batched_rhs`.
+    x_inits: [batch_size, nvars]
+    divergence_threshold: if given, the state is checked every `check_every` steps. Once it is diverged, the integration
+    stops and the rest of the trajectories is filled with inf, which is the "diverged" result.
+    return: [batch_size, time_steps, nvars]
+    """
+    x_inits = as_float_array(x_inits)
+    n = len(times)
+    y = np.zeros((n,) + x_inits.shape, dtype=x_inits.dtype)
+    y[0] = x_inits
+    for i in range(len(times) - 1):
+        h = times[i + 1] - times[i]
+        k1 = func(times[i], y[i])
+        k2 = func(times[i] + h / 2., y[i] + k1 * h / 2)
+        k3 = func(times[i] + h / 2, y[i] + k2 * h / 2)
+        k4 = func(times[i] + h, y[i] + k3 * h)
+        y[i + 1] = y[i] + h / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+        if divergence_threshold is not None and (i + 1) % check_every == 0 \
+                and has_diverged(y[i + 1], divergence_threshold):
+            y[i + 1:] = np.inf
+            break
+    return np.moveaxis(y, 0, -2)
+
+
+def rk4_workspace(shape, dtype=float) -> dict:
+    """
+    the buffers of one RK4 step for the state of the given shape. one workspace can be reused by all the solves with
+    the same shape.
+    """
+    return {name: np.zeros(shape, dtype=dtype) for name in ['k1', 'k2', 'k3', 'k4', 'tmp']}
+
+
+def runge_kutta4_inplace(func, times, x_init, workspace=None, divergence_threshold=None, check_every=1):
+    """
+    same as `runge_kutta4` (or `batch_runge_kutta4` without the axis move), but the stages are written into
+    preallocated buffers with `out=` ufuncs, so a step does not allocate temporary arrays. the operations are done in
+    the same order, so the output is exactly the same. it is not faster than `batch_runge_kutta4` for the lambdified
+    right-hand sides of the candidates, which allocate their own temporaries, so it is only worth it when the memory
+    of the steps matters. See ablation_study/benchmark_rk4_allocations.py.
+    func: `func(t, state, out)` writes the derivative into out. See `batched_rhs`.
+    x_init: [nvars], or [batch_size, nvars]
+    workspace: see `rk4_workspace`. allocated for this solve if None.
+    divergence_threshold, check_every: see `batch_runge_kutta4`.
+    return: [time_steps, nvars], or [time_steps, batch_size, nvars]
+    """
+    x_init = as_float_array(x_init)
+    if workspace is None:
+        workspace = rk4_workspace(x_init.shape, x_init.dtype)
+    k1, k2, k3, k4, tmp = workspace['k1'], workspace['k2'], workspace['k3'], workspace['k4'], workspace['tmp']
+    n = len(times)
+    y = np.zeros((n,) + x_init.shape, dtype=x_init.dtype)
+    y[0] = x_init
+    for i in range(len(times) - 1):
+        h = times[i + 1] - times[i]
+        func(times[i], y[i], k1)
+        # y[i] + k1 * h / 2
+        np.multiply(k1, h, out=tmp)
+        np.divide(tmp, 2, out=tmp)
+        np.add(y[i], tmp, out=tmp)
+        func(times[i] + h / 2., tmp, k2)
+        np.multiply(k2, h, out=tmp)
+        np.divide(tmp, 2, out=tmp)
+        np.add(y[i], tmp, out=tmp)
+        func(times[i] + h / 2, tmp, k3)
+        np.multiply(k3, h, out=tmp)
+        np.add(y[i], tmp, out=tmp)
+        func(times[i] + h, tmp, k4)
+        # y[i] + h / 6 * (k1 + 2 * k2 + 2 * k3 + k4). k2 and k3 are not needed anymore.
+        np.multiply(k2, 2, out=k2)
+        np.add(k1, k2, out=tmp)
+        np.multiply(k3, 2, out=k3)
+        np.add(tmp, k3, out=tmp)
+        np.add(tmp, k4, out=tmp)
+        np.multiply(tmp, h / 6, out=tmp)
+        np.add(y[i], tmp, out=y[i + 1])
+        if divergence_threshold is not None and (i + 1) % check_every == 0 \
+                and has_diverged(y[i + 1], divergence_threshold):
+            y[i + 1:] = np.inf
+            break
+    return y
+
+
+# Dormand-Prince 5(4) tableau and the coefficients of its 4th order dense output (same as scipy.integrate.RK45)
+DOPRI_C = np.array([0, 1 / 5, 3 / 10, 4 / 5, 8 / 9, 1])
+DOPRI_A = [np.array([]),
+           np.array([1 / 5]),
+           np.array([3 / 40, 9 / 40]),
+           np.array([44 / 45, -56 / 15, 32 / 9]),
+           np.array([19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729]),
+           np.array([9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656])]
+DOPRI_B = np.array([35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84])
+DOPRI_E = np.array([-71 / 57600, 0, 71 / 16695, -71 / 1920, 17253 / 339200, -22 / 525, 1 / 40])
+DOPRI_P = np.array([
+    [1, -8048581381 / 2820520608, 8663915743 / 2820520608, -12715105075 / 11282082432],
+    [0, 0, 0, 0],
+    [0, 131558114200 / 32700410799, -68118460800 / 10900136933, 87487479700 / 32700410799],
+    [0, -1754552775 / 470086768, 14199869525 / 1410260304, -10690763975 / 1880347072],
+    [0, 127303824393 / 49829197408, -318862633887 / 49829197408, 701980252875 / 199316789632],
+    [0, -282668133 / 205662961, 2019193451 / 616988883, -1453857185 / 822651844],
+    [0, 40617522 / 29380423, -110615467 / 29380423, 69997945 / 29380423]])
+
+
+def batch_dormand_prince(func, times, x_inits, rtol=1e-6, atol=1e-9, divergence_threshold=None,
+                         max_steps_per_eval=100):
+    """
+    solve a batch of initial conditions with the embedded RK45 (Dormand-Prince) method.
+    the step size is adapted by the error estimate (shared by the whole batch), and the solution is interpolated onto
+    `times` with the dense output of the method.
+    func: see `batch_runge_kutta4`.
+    x_inits: [batch_size, nvars]
+    divergence_threshold: the state is checked after every accepted step. See `batch_runge_kutta4`.
+    max_steps_per_eval: at most `max_steps_per_eval * len(times)` steps. candidates that need more steps (or whose step
+    size underflows) are treated as diverged.
+    return: [batch_size, time_steps, nvars]
+    """
+    x_inits = np.asarray(x_inits, dtype=float)
+    n = len(times)
+    y = np.zeros((n,) + x_inits.shape)
+    y[0] = x_inits
+
+    t_cur, y_cur = times[0], y[0]
+    f_cur = func(t_cur, y_cur)
+    h = (times[-1] - times[0]) / max(n - 1, 1)
+    j = 1  # next time step to be filled in
+    K = np.empty((7,) + x_inits.shape)
+    for _ in range(max_steps_per_eval * n):
+        if j >= n:
+            break
+        if h <= 1e-12 * max(1.0, abs(t_cur)):
+            break
+        t_new = t_cur + h
+        if t_new >= times[-1]:
+            # the last step lands exactly on the final time step.
+            t_new = times[-1]
+            h = t_new - t_cur
+        K[0] = f_cur
+        for s in range(1, 6):
+            dy = np.tensordot(DOPRI_A[s], K[:s], axes=1) * h
+            K[s] = func(t_cur + DOPRI_C[s] * h, y_cur + dy)
+        y_new = y_cur + h * np.tensordot(DOPRI_B, K[:6], axes=1)
+        f_new = func(t_cur + h, y_new)
+        K[6] = f_new
+        scale = atol + np.maximum(np.abs(y_cur), np.abs(y_new)) * rtol
+        error_norm = np.sqrt(np.mean((h * np.tensordot(DOPRI_E, K, axes=1) / scale) ** 2))
+        if not np.isfinite(error_norm):
+            # shrink the step; if the derivative itself is not finite, the step size underflows and we stop.
+            h *= 0.2
+            continue
+        if error_norm > 1:
+            h *= max(0.2, 0.9 * error_norm ** -0.2)
+            continue
+        # accepted step: interpolate the dense output onto the requested time steps in (t_cur, t_new].
+        Q = np.tensordot(DOPRI_P.T, K, axes=([1], [0]))
+        while j < n and times[j] <= t_new:
+            x = (times[j] - t_cur) / h
+            y[j] = y_cur + h * np.tensordot(x ** np.arange(1, 5), Q, axes=1)
+            j += 1
+        t_cur, y_cur, f_cur = t_new, y_new, f_new
+        if divergence_threshold is not None and has_diverged(y_cur, divergence_threshold):
+            break
+        h *= min(10.0, 0.9 * error_norm ** -0.2) if error_norm > 0 else 10.0
+    y[j:] = np.inf
+    return np.moveaxis(y, 0, -2)
+
+
 def numpy_implementation():
     from sympy import symbols, lambdify
     import numpy as np
@@ -1,29 +1,112 @@
 import time
 
+import numpy as np
 import torch
 import warnings
+from sympy import lambdify
 
 warnings.filterwarnings("ignore", category=RuntimeWarning)
 
-if torch.cuda.is_available():
-    torch.set_default_device('cuda')
+# the functions used by the production rules, evaluated with torch so that autograd can flow through the candidates.
+TORCH_MODULES = {
+    'sin': torch.sin, 'cos': torch.cos, 'tan': torch.tan,
+    'exp': torch.exp, 'log': torch.log, 'sqrt': torch.sqrt,
+    'power': torch.pow, 'Abs': torch.abs,
+}
 
 
-def runge_kutta4(func, times, x_init):
+def lambdify_torch(args, expr_odes):
     """
-    solve a batch of initial conditions
+    lambdify the sympy expressions into a function on torch tensors. the common subexpressions are computed once.
     """
-    n = len(times)
-    y = torch.zeros((n, len(x_init)))
-    y[0] = x_init
+    return lambdify(args, expr_odes, modules=[TORCH_MODULES], cse=True)
+
+
+def batched_rhs(func):
+    """
+    torch version of `numpy_odeint.batched_rhs`: wrap `func(t, [X0, X1, ...])` so that it maps a state tensor of shape
+    [..., nvars] to its time derivative of the same shape. Constant components are broadcast over the batch.
+    """
+
+    def derivative(t, state):
+        zeros = torch.zeros_like(state[..., 0])
+        return torch.stack([zeros + di for di in func(t, torch.movedim(state, -1, 0))], dim=-1)
+
+    return derivative
+
+
+def batch_runge_kutta4(func, times, x_inits, divergence_threshold=None):
+    """
+    solve a batch of initial conditions at once. the steps are not done in place, so autograd works through them.
+    func: maps (t, state) to the derivative, where state has the shape [..., nvars]. See `batched_rhs`.
+    x_inits: [batch_size, nvars]
+    divergence_threshold: see `numpy_odeint.batch_runge_kutta4`.
+    return: [batch_size, time_steps, nvars]
+    """
+    ys = [x_inits]
     for i in range(len(times) - 1):
         h = times[i + 1] - times[i]
-        k1 = torch.tensor(func(times[i], y[i]))
-        k2 = torch.tensor(func(times[i] + h / 2., y[i] + k1 * h / 2))
-        k3 = torch.tensor(func(times[i] + h / 2, y[i] + k2 * h / 2))
-        k4 = torch.tensor(func(times[i] + h, y[i] + k3 * h))
-        y[i + 1] = y[i] + h / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
-    return y
+        y = ys[-1]
+        k1 = func(times[i], y)
+        k2 = func(times[i] + h / 2., y + k1 * h / 2)
+        k3 = func(times[i] + h / 2, y + k2 * h / 2)
+        k4 = func(times[i] + h, y + k3 * h)
+        ys.append(y + h / 6 * (k1 + 2 * k2 + 2 * k3 + k4))
+        if divergence_threshold is not None and not bool(torch.all(torch.abs(ys[-1]) <= divergence_threshold)):
+            ys.extend([torch.full_like(x_inits, np.inf)] * (len(times) - len(ys)))
+            break
+    return torch.stack(ys, dim=-2)
+
+
+def fit_stacked_constants(func, theta0, constant_owners, t_evals, stacked_inits, true_trajectories, n_candidates,
+                          optimizer_name='Adam', max_opt_iter=100, learning_rate=0.05):
+    """
+    fit the constants of many candidates at once with autograd.
+    the candidates are stacked along the last axis (see `minimize_coefficients.optimize_many`), so the loss of the
+    k-th candidate only depends on its own constants, and summing the losses fits all of them together.
+
+    func: derivative of the stacked state, `func(t, state, theta)`. state: [batch_size, n_candidates * nvars]
+    theta0: initial values of all the constants (concatenated over candidates).
+    constant_owners: index of the candidate owning each constant in theta0.
+    true_trajectories: [batch_size, time_steps, nvars]
+    return: the best constants of every candidate and the normalized mse of every candidate.
+    """
+    times = torch.as_tensor(t_evals, dtype=torch.float64)
+    inits = torch.as_tensor(stacked_inits, dtype=torch.float64)
+    y_true = torch.as_tensor(true_trajectories, dtype=torch.float64).unsqueeze(2)
+    var_ytrue = torch.var(y_true, unbiased=False)
+    theta = torch.tensor(theta0, dtype=torch.float64, requires_grad=True)
+    owners = torch.as_tensor(constant_owners, dtype=torch.long)
+    best = {'theta': theta.detach().clone(), 'losses': torch.full((n_candidates,), np.inf, dtype=torch.float64)}
+
+    def closure():
+        optimizer.zero_grad()
+        pred = batch_runge_kutta4(lambda t, state: func(t, state, theta), times, inits)
+        pred = pred.reshape(pred.shape[:2] + (n_candidates, -1))
+        losses = torch.mean((pred - y_true) ** 2, dim=(0, 1, 3)) / var_ytrue
+        with torch.no_grad():
+            # each candidate keeps its own best constants, whatever happens to the others.
+            improved = torch.isfinite(losses) & (losses < best['losses'])
+            best['losses'] = torch.where(improved, losses, best['losses'])
+            best['theta'] = torch.where(improved[owners], theta, best['theta'])
+        total = torch.sum(losses[torch.isfinite(losses)])
+        if total.requires_grad:
+            total.backward()
+            # diverged candidates leak NaN into their own constants only; keep them where they are.
+            theta.grad.nan_to_num_(nan=0.0, posinf=0.0, neginf=0.0)
+        return total
+
+    if optimizer_name == 'LBFGS':
+        # one step runs the whole quasi-newton loop.
+        optimizer = torch.optim.LBFGS([theta], lr=1, max_iter=max_opt_iter, line_search_fn='strong_wolfe')
+        optimizer.step(closure)
+    elif optimizer_name == 'Adam':
+        optimizer = torch.optim.Adam([theta], lr=learning_rate)
+        for _ in range(max_opt_iter):
+            optimizer.step(closure)
+    else:
+        raise NotImplementedError(optimizer_name, "is not implemented....")
+    return best['theta'].numpy(), best['losses'].numpy()
 
 
 def f(t, y):
@@ -35,16 +118,16 @@ def f(t, y):
 def verify():
     # print(ydot)
 
-    y0 = [1, 0, 1]  # initial condition (initial values)
-    y0 = torch.tensor(y0).T
+    y0 = [[1, 0, 1], [0.5, 0.5, 1]]  # a batch of initial conditions (initial values)
+    y0 = torch.tensor(y0, dtype=torch.float64)
 
     print(y0.shape)
-    t_eval = torch.linspace(0, 100, 5000)
+    t_eval = torch.linspace(0, 100, 5000, dtype=torch.float64)
     st = time.time()
-    solution = runge_kutta4(func=f, times=t_eval, x_init=y0)
+    solution = batch_runge_kutta4(func=batched_rhs(f), times=t_eval, x_inits=y0)
     # Extract the y (concentration) values from SciPy solution result
     used_time = time.time() - st
-    print("used time", used_time)
+    print("used time", used_time, solution.shape)
 
     # Plot the result graphically using matplotlib
 
@@ -0,0 +1,92 @@
+"""
+share the data of one epoch (the initial conditions, the true trajectories, the fitting settings, ...) with the workers
+of the process pool through one block of shared memory, so the tasks only carry their candidates.
+"""
+import pickle
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+
+# the arrays are aligned in the block, so the views of the workers are aligned as well.
+_ALIGNMENT = 64
+
+
+class SharedOracle(object):
+    """
+    the owner side, in the main process. the arrays are copied once into a new block of shared memory, followed by the
+    pickled values (which have to be picklable without dill, e.g., no lambda). `handle` is the small tuple the tasks
+    carry to find them, see `attach_oracle`.
+    writable: the names of the arrays the workers may write to, e.g., to report their progress. `self.arrays` are the
+              views of the owner.
+    """
+
+    def __init__(self, arrays: dict, values: dict, writable=()):
+        arrays = {name: np.ascontiguousarray(arr) for name, arr in arrays.items()}
+        payload = pickle.dumps(values)
+        layout = []
+        offset = 0
+        for name, arr in arrays.items():
+            layout.append((name, arr.dtype.str, arr.shape, offset, name in writable))
+            offset += -(-arr.nbytes // _ALIGNMENT) * _ALIGNMENT
+        self.block = shared_memory.SharedMemory(create=True, size=max(offset + len(payload), 1))
+        self.arrays = {}
+        for name, dtype, shape, start, _ in layout:
+            self.arrays[name] = np.ndarray(shape, dtype=dtype, buffer=self.block.buf, offset=start)
+            self.arrays[name][...] = arrays[name]
+        self.block.buf[offset:offset + len(payload)] = payload
+        self.handle = (self.block.name, tuple(layout), offset, len(payload))
+
+    def close(self):
+        """release the block. the workers attached to it keep their mapping until they attach to the next one."""
+        self.arrays = {}
+        _release(self.block)
+        self.block.unlink()
+
+
+# the block attached by this (worker) process, and its arrays and values: (name, block, data).
+_attached = [None, None, None]
+
+
+def attach_oracle(handle) -> dict:
+    """
+    the worker side: the arrays (read-only views of the shared block) and the values of the handle, as one dict.
+    a process attaches to every block once, and releases the block of the previous epoch then.
+    """
+    name, layout, payload_start, payload_size = handle
+    if _attached[0] == name:
+        return _attached[2]
+    block = _attach_untracked(name)
+    data = pickle.loads(bytes(block.buf[payload_start:payload_start + payload_size]))
+    for one_name, dtype, shape, start, writable in layout:
+        arr = np.ndarray(shape, dtype=dtype, buffer=block.buf, offset=start)
+        arr.flags.writeable = writable
+        data[one_name] = arr
+    previous_block = _attached[1]
+    _attached[:] = [name, block, data]
+    if previous_block is not None:
+        # the views of the previous block went with its data.
+        _release(previous_block)
+    return data
+
+
+def _attach_untracked(name):
+    # the owner tracks (and unlinks) the block, so the attaching process should not register it with the resource
+    # tracker, which may be the one of the owner.
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # before python 3.13.
+        register = resource_tracker.register
+        resource_tracker.register = lambda *args: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+def _release(block):
+    try:
+        block.close()
+    except BufferError:
+        # a view of its arrays is still alive somewhere; the mapping goes with the process.
+        pass
@@ -1,16 +1,77 @@
+import signal
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+
 import sympy
 from sympy.core.numbers import Float, Rational, NegativeOne, Integer
 from sympy import simplify, expand, Symbol
 from sympy.parsing.sympy_parser import parse_expr
 
+from grammar.expression_tree import tree_from_str, canonical_tree
+
+# seconds given to sympy simplify per expression, see `pretty_print_expr`.
+SIMPLIFY_TIME_BUDGET = 1.0
+
+
+class _SimplifyTimeout(BaseException):
+    # not an Exception, so that sympy can not swallow it half way.
+    pass
+
+
+@contextmanager
+def time_limit(seconds):
+    """
+    raise _SimplifyTimeout in the block once it runs over seconds. the alarm only works in the main thread of a process
+    (this includes the workers of the process pool); elsewhere, the block runs without any limit.
+    """
+    if seconds is None or not hasattr(signal, 'setitimer') or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def on_alarm(signum, frame):
+        raise _SimplifyTimeout()
+
+    previous = signal.signal(signal.SIGALRM, on_alarm)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
 
-def pretty_print_expr(eq) -> str:
+
+def canonical_form(templates: list, var_names: list) -> tuple:
+    '''
+    cheap deterministic form of the templates, for hashing and deduplication: the chains of sums and products are
+    flattened and sorted without sympy, but nothing is simplified. see `expression_tree.canonical_tree`.
+    a template the expression tree does not support is kept as it is.
+    '''
+    try:
+        return tuple(canonical_tree(tree_from_str(one_template, var_names, ['C'])) for one_template in templates)
+    except ValueError:
+        return tuple(templates)
+
+
+def pretty_print_expr(eq, time_budget=None) -> str:
     '''
     ask sympy simplify to pretty print the expression.
+    simplify may take seconds on large expressions, so it runs under a time budget (SIMPLIFY_TIME_BUDGET by default);
+    once over the budget, the unsimplified expression is printed instead.
+    the results are memoized by the expression string before simplification.
     '''
-    if type(eq) == str:
-        eq = parse_expr(eq)
-    return str(expand(simplify(eq)))
+    return _pretty_print_str(str(eq), SIMPLIFY_TIME_BUDGET if time_budget is None else time_budget)
+
+
+@lru_cache(maxsize=4096)
+def _pretty_print_str(eq: str, time_budget) -> str:
+    eq = parse_expr(eq)
+    try:
+        with time_limit(time_budget):
+            return str(expand(simplify(eq)))
+    except _SimplifyTimeout:
+        print("simplify is over the time budget of {}s: {}".format(time_budget, eq))
+        return str(eq)
 
 
 def nth_repl(s, sub, repl, n):